@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""Mock Webex API server for the webex-archive benchmarks.
+Serves synthetic spaces on /v1/rooms, /v1/messages, /v1/memberships, /v1/people, /v1/people/me
+and /v1/contents (attachment downloads, with Range requests), plus the avatar images.
+Every message is generated from its space and position, so even huge spaces take no memory.
+Latency and '429 Too Many Requests' responses can be injected.
+
+Run it on its own:
+    python mock_webex.py --port 8765 --spaces 5x100,1x10000 --latency 20
+and point the backup at it:
+    python ../webex-archive.py --batch --set apiBaseURL=http://127.0.0.1:8765/v1 <any 55+ character token>
+GET /_stats returns what the server has seen (connections, requests per endpoint, 429 responses).
+"""
+import argparse
+import base64
+import datetime
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+imageNames = ["photo.jpg", "screenshot.png", "diagram.png", "whiteboard.jpg", "animation.gif"]
+fileNames = ["report.pdf", "minutes.docx", "budget.xlsx", "slides.pptx", "logs.zip", "notes.txt"]
+domains = ["example.com", "example.com", "example.com", "partner.org"]
+# a 1x1 pixel PNG, used for all avatars
+avatarImage = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII=")
+
+
+# ----------------------------------------------------------------------------------------
+# CLASS synthetic space. Message 0 is the oldest, message messageCount-1 the newest.
+#       threadShare: share of the messages that start a thread, threadDepth: replies per thread
+#       fileShare: share of the messages with attachments, imageShare: share of those that are images
+#       fileSize: average attachment size in bytes
+#       direct: a one-on-one chat (2 members) instead of a group space
+#       interval: seconds between the messages, burst: number of messages sent at the same time
+class MockSpace:
+    def __init__(self, number, messageCount, members=10, threadShare=0.1, threadDepth=3,
+                 fileShare=0.1, imageShare=0.6, fileSize=20000, direct=False, endDate=None, interval=600, burst=1):
+        self.number = number
+        self.roomId = f"ROOM{number:05d}"
+        self.messageCount = messageCount
+        self.members = 2 if direct else members
+        self.threadShare = threadShare
+        self.threadDepth = threadDepth
+        self.fileShare = fileShare
+        self.imageShare = imageShare
+        self.fileSize = fileSize
+        self.interval = interval
+        self.burst = burst
+        self.endDate = endDate or datetime.datetime(2026, 1, 1)
+        self.type = "direct" if direct else "group"
+        self.title = f"User {number}" if direct else f"Mock space {number}"
+
+    def created(self, messageNr):
+        return self.endDate - datetime.timedelta(seconds=(self.messageCount - 1 - messageNr) // self.burst * self.interval)
+
+    def message_id(self, messageNr):
+        return f"{self.roomId}-MSG{messageNr:08d}"
+
+    def message_number(self, messageId):
+        return int(messageId.rsplit("-MSG", 1)[1])
+
+    def room(self):
+        lastActivity = self.created(self.messageCount - 1) if self.messageCount > 0 else self.endDate - datetime.timedelta(days=3650)
+        return {'id': self.roomId, 'title': self.title, 'type': self.type, 'isLocked': False,
+                'lastActivity': webex_date(lastActivity), 'created': webex_date(self.created(0) - datetime.timedelta(days=1))}
+
+    def person(self, personNr):
+        return {'personId': f"PERSON{personNr:06d}", 'personEmail': f"user{personNr}@{domains[personNr % len(domains)]}",
+                'personDisplayName': f"User {personNr}"}
+
+    # replies follow their thread root: block of threadDepth+1 messages starting with the root
+    def parent(self, messageNr):
+        if self.threadDepth == 0 or self.threadShare == 0:
+            return None
+        blockSize = self.threadDepth + 1
+        root = messageNr - messageNr % blockSize
+        if root == messageNr or random.Random(f"{self.roomId}-thread-{root}").random() >= self.threadShare:
+            return None
+        return root
+
+    def message(self, messageNr, baseURL):
+        rng = random.Random(f"{self.roomId}-{messageNr}")
+        author = self.person(rng.randrange(self.members))
+        msg = {'id': self.message_id(messageNr), 'roomId': self.roomId, 'roomType': self.type,
+               'personId': author['personId'], 'personEmail': author['personEmail'],
+               'created': webex_date(self.created(messageNr))}
+        link = f"https://docs.example.com/item/{rng.randrange(100000)}"
+        kind = rng.random()
+        if kind < 0.4:
+            msg['text'] = f"Message {messageNr}: " + " ".join(rng.choice(["ok", "meeting", "tomorrow", "thanks", "the", "build", "is", "green", "see"]) for _ in range(rng.randrange(3, 40)))
+        elif kind < 0.6:
+            msg['text'] = f"Please check {link} and {link}/details"
+        elif kind < 0.75:
+            msg['text'] = f"Check the doc please"
+            msg['markdown'] = f"Check [the doc]({link}) please"
+            msg['html'] = (f"<p>Check <a href=\"{link}\" alt=\"{link}\" onClick=\"javascript:event.stopPropagation();"
+                           f"sparkBase.clickEventHandler(event);\">the doc</a> please</p>")
+        elif kind < 0.9:
+            mentioned = self.person(rng.randrange(self.members))
+            msg['text'] = f"{mentioned['personDisplayName']} can you look at {link}"
+            msg['html'] = (f"<p><spark-mention data-object-type=\"person\" data-object-id=\"{mentioned['personId']}\">"
+                           f"{mentioned['personDisplayName']}</spark-mention> can you look at {link}</p>")
+            msg['mentionedPeople'] = [mentioned['personId']]
+        else:
+            msg['text'] = "All: <b>release</b> is done"
+            msg['html'] = ("<p><spark-mention data-object-type=\"groupMention\" data-group-type=\"all\">All</spark-mention>"
+                           ": <strong>release</strong> is done</p><ul><li>one</li><li>two</li></ul>")
+            msg['mentionedGroups'] = ["all"]
+        if rng.random() < self.fileShare:
+            msg['files'] = [f"{baseURL}/contents/{self.roomId}-{messageNr}-{fileNr}" for fileNr in range(rng.choice([1, 1, 1, 2, 3]))]
+        parent = self.parent(messageNr)
+        if parent is not None:
+            msg['parentId'] = self.message_id(parent)
+        return msg
+
+    # newest first: the messages before 'beforeMessage' or 'before' (a date)
+    def messages(self, baseURL, maxCount, beforeMessage=None, before=None):
+        top = self.messageCount
+        if beforeMessage:
+            top = self.message_number(beforeMessage)
+        if before:   # the first message that is not older than 'before' (binary search, dates only go up)
+            low, high, beforeDate = 0, self.messageCount, parse_date(before)
+            while low < high:
+                middle = (low + high) // 2
+                if self.created(middle) < beforeDate:
+                    low = middle + 1
+                else:
+                    high = middle
+            top = min(top, low)
+        top = max(0, min(top, self.messageCount))
+        bottom = max(0, top - maxCount)
+        return [self.message(messageNr, baseURL) for messageNr in range(top - 1, bottom - 1, -1)], bottom
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTIONs for the Webex date format ("2018-02-01T13:45:10.123Z")
+def webex_date(date):
+    return date.strftime("%Y-%m-%dT%H:%M:%S.") + f"{date.microsecond // 1000:03d}Z"
+
+def parse_date(text):
+    return datetime.datetime.strptime(text.replace("Z", ""), "%Y-%m-%dT%H:%M:%S.%f" if "." in text else "%Y-%m-%dT%H:%M:%S")
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTIONs for the paging cursors: base64 that always ends with '==' (like the Webex cursors)
+def make_cursor(offset):
+    return base64.urlsafe_b64encode(f"{offset:010d}".encode()).decode()
+
+def read_cursor(cursor):
+    cursor = cursor.rstrip("=")
+    return int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that parses a spaces specification like "5x100,1x10000" (5 spaces of 100 messages and
+#          one of 10000) into a list of MockSpaces. directShare of them are one-on-one chats,
+#          other MockSpace settings go in spaceSettings.
+def make_spaces(specification, directShare=0.3, **spaceSettings):
+    spaces = list()
+    for part in specification.split(","):
+        count, _, messageCount = part.strip().partition("x")
+        for _ in range(int(count)):
+            direct = random.Random(f"direct-{len(spaces)}").random() < directShare
+            spaces.append(MockSpace(len(spaces), int(messageCount), direct=direct, **spaceSettings))
+    return spaces
+
+
+# ----------------------------------------------------------------------------------------
+# CLASS the mock server. latency: seconds added to every response (plus 0..jitter),
+#       throttleShare: share of the requests that get a 429 with a Retry-After of retryAfter seconds
+class MockWebexServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, spaces, port=0, latency=0.0, jitter=0.0, throttleShare=0.0, retryAfter=1):
+        super().__init__(('127.0.0.1', port), MockWebexHandler)
+        self.spaces = {space.roomId: space for space in spaces}
+        self.latency = latency
+        self.jitter = jitter
+        self.throttleShare = throttleShare
+        self.retryAfter = retryAfter
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def baseURL(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'connections': 0, 'requests': 0, 'throttled': 0, 'bytesSent': 0, 'endpoints': dict()}
+
+    def count(self, name, amount=1, endpoint=None):
+        with self.lock:
+            self.stats[name] += amount
+            if endpoint is not None:
+                self.stats['endpoints'][endpoint] = self.stats['endpoints'].get(endpoint, 0) + amount
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MockWebexHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive: one handler per connection
+    disable_nagle_algorithm = True   # headers and body are separate writes: no delayed-ACK stalls
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body=b"", headers=None, bodyInHead=False):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if 'Content-Length' not in (headers or {}):
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+            self.server.count('bytesSent', len(body))
+
+    def send_json(self, data, link=None):
+        headers = {'Content-Type': 'application/json; charset=utf-8'}
+        if link is not None:
+            headers['Link'] = f'<{link}>; rel="next"'
+        self.send(200, json.dumps(data).encode(), headers)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        path = url.path.rstrip("/").split("/")[1:]
+        if path == ["_stats"]:
+            with self.server.lock:
+                return self.send_json(self.server.stats)
+        endpoint = path[1] if len(path) >= 2 and path[0] == "v1" else path[0] if path else ""
+        self.server.count('requests', endpoint=endpoint)
+        if self.server.latency or self.server.jitter:
+            time.sleep(self.server.latency + random.random() * self.server.jitter)
+        if self.server.throttleShare and random.random() < self.server.throttleShare:
+            self.server.count('throttled')
+            return self.send(429, headers={'Retry-After': str(self.server.retryAfter)})
+        baseURL = f"http://{self.headers['Host']}/v1"
+        space = self.server.spaces.get(query.get('roomId', ""))
+        if path == ["v1", "rooms"]:
+            rooms = sorted((space.room() for space in self.server.spaces.values()), key=lambda room: room['lastActivity'], reverse=True)
+            return self.send_page(rooms, query, f"{baseURL}/rooms?sortBy=lastactivity")
+        if path[:2] == ["v1", "rooms"] and len(path) == 3 and path[2] in self.server.spaces:
+            return self.send_json(self.server.spaces[path[2]].room())
+        if path == ["v1", "messages"] and space is not None:
+            maxCount = int(query.get('max', 50))
+            items, bottom = space.messages(baseURL, maxCount, query.get('beforeMessage'), query.get('before'))
+            link = None
+            if bottom > 0 and len(items) > 0:
+                link = f"{baseURL}/messages?roomId={space.roomId}&max={maxCount}&beforeMessage={space.message_id(bottom)}"
+            return self.send_json({'items': items}, link)
+        if path == ["v1", "memberships"] and space is not None:
+            members = [dict(space.person(personNr), id=f"{space.roomId}-MEMBER{personNr}", roomId=space.roomId)
+                       for personNr in range(space.members)]
+            return self.send_page(members, query, f"{baseURL}/memberships?roomId={space.roomId}")
+        if path == ["v1", "people", "me"]:
+            return self.send_json({'id': "PERSONME", 'emails': ["me@example.com"], 'displayName': "Mock User"})
+        if path == ["v1", "people"]:
+            return self.send_json({'items': [{'id': personId, 'displayName': personId,
+                                              'avatar': f"http://{self.headers['Host']}/avatars/{personId}~1600"}
+                                             for personId in query.get('id', "").split(",") if personId != ""]})
+        if path[:2] == ["v1", "contents"] and len(path) == 3:
+            return self.send_content(path[2])
+        if path[:1] == ["avatars"]:
+            return self.send(200, avatarImage, {'Content-Type': 'image/png'})
+        return self.send(404)
+
+    def send_page(self, items, query, linkBase):
+        maxCount = int(query.get('max', 100))
+        offset = read_cursor(query['cursor']) if 'cursor' in query else 0
+        link = None
+        if offset + maxCount < len(items):
+            link = f"{linkBase}&max={maxCount}&cursor={make_cursor(offset + maxCount)}"
+        return self.send_json({'items': items[offset:offset + maxCount]}, link)
+
+    # attachment <roomId>-<message number>-<file number>: name and size follow from the space settings
+    def send_content(self, contentId):
+        try:
+            roomId, messageNr, fileNr = contentId.rsplit("-", 2)
+            space = self.server.spaces[roomId]
+        except (KeyError, ValueError):
+            return self.send(404)
+        rng = random.Random(contentId)
+        if rng.random() < space.imageShare:
+            filename = rng.choice(imageNames)
+        else:
+            filename = rng.choice(fileNames)
+        size = max(1, int(rng.expovariate(1 / space.fileSize)))
+        start = 0
+        status = 200
+        headers = {'Content-Disposition': f'attachment; filename="{filename}"', 'Content-Type': 'application/octet-stream'}
+        byteRange = self.headers.get('Range', "")
+        if byteRange.startswith("bytes=") and byteRange.endswith("-"):
+            start = int(byteRange[6:-1])
+            if start >= size:
+                return self.send(416, headers={'Content-Range': f"bytes */{size}"})
+            status = 206
+            headers['Content-Range'] = f"bytes {start}-{size - 1}/{size}"
+        headers['Content-Length'] = str(size - start)
+        pattern = (contentId + "\n").encode()
+        body = (pattern * (size // len(pattern) + 1))[start:size]
+        return self.send(status, body, headers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Webex API server for the webex-archive benchmarks.")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--spaces', default="5x100", help="spaces as COUNTxMESSAGES[,COUNTxMESSAGES...] (default: 5x100)")
+    parser.add_argument('--members', type=int, default=10, help="members per group space")
+    parser.add_argument('--direct-share', type=float, default=0.3, help="share of the spaces that are one-on-one chats")
+    parser.add_argument('--thread-share', type=float, default=0.1, help="share of the messages that start a thread")
+    parser.add_argument('--thread-depth', type=int, default=3, help="replies per thread")
+    parser.add_argument('--file-share', type=float, default=0.1, help="share of the messages with attachments")
+    parser.add_argument('--image-share', type=float, default=0.6, help="share of the attachments that are images")
+    parser.add_argument('--file-size', type=int, default=20000, help="average attachment size in bytes")
+    parser.add_argument('--latency', type=float, default=0.0, help="milliseconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random extra milliseconds (0..jitter)")
+    parser.add_argument('--throttle-share', type=float, default=0.0, help="share of the requests that get a 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds of the 429 responses")
+    args = parser.parse_args()
+    server = MockWebexServer(make_spaces(args.spaces, args.direct_share, members=args.members, threadShare=args.thread_share, threadDepth=args.thread_depth,
+                                         fileShare=args.file_share, imageShare=args.image_share, fileSize=args.file_size),
+                             args.port, args.latency / 1000, args.jitter / 1000, args.throttle_share, args.retry_after)
+    print(f"Mock Webex API on {server.baseURL} with {len(server.spaces)} spaces")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
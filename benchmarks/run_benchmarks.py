@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for webex-archive.py, against the mock Webex API (mock_webex.py). No Webex account needed.
+    python run_benchmarks.py                      all benchmarks with the small and medium scenarios
+    python run_benchmarks.py endtoend --scenarios small,medium,huge --latency 50
+    python run_benchmarks.py dates text --json results.json
+Benchmarks:
+    endtoend  full backups of the small, medium and huge scenarios: time, API requests, connections
+              opened and peak memory (RSS) of the backup process
+    render    backups of one space of 1000..8000 messages: the HTML generation time per message
+              should stay the same (linear scaling) and the peak memory should hardly grow
+    history   retrieving the messages of one big space in 1..8 date ranges at the same time (historyShards),
+              checked against the known messages of the space
+    pages     pages/second of the message pager with the work of a backup on each page: one request at a
+              time against requesting the next page while the current one is processed (20 ms latency
+              if --latency is not given)
+    dates     the date helpers: parse each date once (MessageTime) against strptime in every helper
+    text      the message text conversion (links, markdown, mentions) on a corpus of Webex messages
+Every backup runs in its own process (peak memory), the mock server in a thread of this process.
+(the history benchmark runs in this process too: use --latency to see the effect of the date ranges)
+"""
+import argparse
+import contextlib
+import datetime
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+try:
+    import resource   # peak memory of the backup process, not available on Windows
+except ImportError:
+    resource = None
+
+import mock_webex
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+scriptFile = os.path.join(os.path.dirname(benchDir), "webex-archive.py")
+benchToken = "mock" * 15   # the mock server accepts any token (the script wants 55+ characters)
+
+# spaces of each scenario, as COUNTxMESSAGES (see mock_webex.make_spaces)
+scenarios = {'small': "10x100",
+             'medium': "10x2000",
+             'huge': "1x100000"}
+renderSizes = [1000, 2000, 4000, 8000]
+historyShardCounts = [1, 2, 4, 8]
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that imports webex-archive.py (the '-' in the name prevents a normal import)
+def load_script():
+    spec = importlib.util.spec_from_file_location("webex_archive", scriptFile)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that returns the peak memory (RSS) of this process in MB (None on Windows)
+def peak_rss():
+    if resource is None:
+        return None
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":   # bytes on macOS, KB on Linux
+        return round(maxRSS / 1048576, 1)
+    return round(maxRSS / 1024, 1)
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION run in the backup process (--child): backs up all spaces of the mock server to folder
+#          and prints the result (time, peak memory and the metrics of the run) as JSON.
+def run_child(baseURL, folder, settings):
+    webexArchive = load_script()
+    webexArchive.configure(dict({'apiBaseURL': baseURL, 'backupFolder': folder, 'apiRequestsPerSecond': 10000,
+                                 'metricsReport': 'no', 'downloadFiles': 'files'}, **settings))
+    startTime = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        spaces = webexArchive.run_backup(benchToken, '3')
+    seconds = time.perf_counter() - startTime
+    report = webexArchive.metrics.to_dict(spaces)
+    print(json.dumps({'seconds': round(seconds, 3), 'peakRSS': peak_rss(), 'failed': sum(space.result == "failed" for space in spaces),
+                      'counters': report['counters'], 'spans': report['spans']}))
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that backs up the spaces of a mock server in a new process and returns its result,
+#          with the connections and requests seen by the mock server.
+#          spaceSpec: see mock_webex.make_spaces, spaceSettings: MockSpace settings,
+#          settings: settings of the backup (see configure() in webex-archive.py)
+def backup_benchmark(spaceSpec, settings=None, spaceSettings=None, latency=0.0, throttleShare=0.0):
+    server = mock_webex.MockWebexServer(mock_webex.make_spaces(spaceSpec, **(spaceSettings or {})),
+                                        latency=latency, throttleShare=throttleShare).start()
+    folder = tempfile.mkdtemp(prefix="webex-benchmark-")
+    try:
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", server.baseURL, folder, json.dumps(settings or {})],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if child.returncode != 0:
+            raise RuntimeError("backup failed:\n" + child.stderr)
+        result = json.loads(child.stdout.strip().splitlines()[-1])
+        with server.lock:
+            result['server'] = json.loads(json.dumps(server.stats))
+        result['server']['spaces'] = list(server.spaces)
+    finally:
+        server.stop()
+        shutil.rmtree(folder, ignore_errors=True)
+    result['messages'] = sum(space.messageCount for space in server.spaces.values())
+    return result
+
+
+# ----------------------------------------------------------------------------------------
+# BENCHMARK full backups of the scenarios
+def bench_endtoend(args):
+    results = dict()
+    print(f"\n endtoend (latency {args.latency:.0f} ms, 429 share {args.throttle_share})")
+    print(f" {'scenario':10} {'spaces':>7} {'messages':>9} {'seconds':>8} {'msg/s':>8} {'requests':>9} {'connections':>12} {'429s':>5} {'peak MB':>8}")
+    for scenario in args.scenarios:
+        result = backup_benchmark(scenarios[scenario], args.settings, latency=args.latency / 1000, throttleShare=args.throttle_share)
+        results[scenario] = result
+        print(f" {scenario:10} {len(result['server']['spaces']):7} "
+              f"{result['messages']:9} {result['seconds']:8.2f} {result['messages'] / result['seconds']:8.0f} {result['counters'].get('API requests', 0):9} "
+              f"{result['server']['connections']:12} {result['server']['throttled']:5} {result['peakRSS'] or '-':>8}")
+        if result['failed']:
+            print(f"   **ERROR** {result['failed']} spaces failed")
+    return results
+
+
+# ----------------------------------------------------------------------------------------
+# BENCHMARK HTML generation of one space at growing sizes (no attachments, so only the messages count)
+def bench_render(args):
+    results = dict()
+    print("\n render (one space, no attachments)")
+    print(f" {'messages':>9} {'seconds':>8} {'HTML seconds':>13} {'us/message':>11} {'peak MB':>8}")
+    for size in renderSizes:
+        result = backup_benchmark(f"1x{size}", args.settings, {'fileShare': 0}, latency=args.latency / 1000)
+        htmlSeconds = result['spans'].get('backup space/generate HTML', {}).get('seconds', 0)
+        results[size] = result
+        print(f" {size:9} {result['seconds']:8.2f} {htmlSeconds:13.3f} {htmlSeconds / size * 1e6:11.1f} {result['peakRSS'] or '-':>8}")
+    return results
+
+
+# ----------------------------------------------------------------------------------------
+# The date helpers before dates were parsed once (reference for bench_dates): strptime in every call
+def old_convertDate(inputdate, hourdelta):
+    dateMSG = datetime.datetime.strptime(inputdate, "%Y-%m-%dT%H:%M:%S.%fZ")
+    return datetime.datetime.strftime(dateMSG + datetime.timedelta(hours=hourdelta), "%A, %H:%M      (%b %d, %Y)")
+
+def old_get_monthday(inputdate):
+    myyear = datetime.datetime.strptime(inputdate, "%Y-%m-%dT%H:%M:%S.%fZ").strftime("%Y")
+    mymonth = datetime.datetime.strptime(inputdate, "%Y-%m-%dT%H:%M:%S.%fZ").strftime("%b")
+    mymonthnr = datetime.datetime.strptime(inputdate, "%Y-%m-%dT%H:%M:%S.%fZ").strftime("%m")
+    return myyear, mymonth, mymonthnr
+
+def old_timedifference(newdate, previousdate):
+    tdelta = datetime.datetime.strptime(newdate, "%Y-%m-%dT%H:%M:%S.%fZ") - datetime.datetime.strptime(previousdate, "%Y-%m-%dT%H:%M:%S.%fZ")
+    return tdelta.seconds
+
+
+# ----------------------------------------------------------------------------------------
+# BENCHMARK the date helpers for each message, as in the HTML generation
+def bench_dates(args):
+    webexArchive = load_script()
+    space = mock_webex.MockSpace(0, args.corpus)
+    created = [mock_webex.webex_date(space.created(messageNr)) for messageNr in range(args.corpus)]
+
+    startTime = time.perf_counter()
+    for previous, current in zip(created, created[1:]):
+        old_convertDate(current, webexArchive.UTChourDelta)
+        old_get_monthday(current)
+        old_timedifference(current, previous)
+    oldSeconds = time.perf_counter() - startTime
+
+    messages = [{'created': date} for date in created]
+    startTime = time.perf_counter()
+    for previous, current in zip(messages, messages[1:]):
+        webexArchive.convertDate(current)
+        webexArchive.get_monthday(current)
+        webexArchive.timedifference(current, previous)
+    newSeconds = time.perf_counter() - startTime
+
+    print(f"\n dates ({args.corpus} messages)")
+    print(f" strptime per helper: {oldSeconds:7.3f}s  ({oldSeconds / args.corpus * 1e6:6.1f} us/message)")
+    print(f" parsed once:         {newSeconds:7.3f}s  ({newSeconds / args.corpus * 1e6:6.1f} us/message)  {oldSeconds / newSeconds:5.1f}x faster")
+    return {'messages': args.corpus, 'oldSeconds': round(oldSeconds, 4), 'newSeconds': round(newSeconds, 4)}
+
+
+# ----------------------------------------------------------------------------------------
+# BENCHMARK the text conversion on the mock messages: plain text with links, markdown links,
+#           person and group mentions (the mix of mock_webex.MockSpace.message)
+def bench_text(args):
+    webexArchive = load_script()
+    space = mock_webex.MockSpace(0, args.corpus)
+    corpus = [space.message(messageNr, "http://127.0.0.1/v1") for messageNr in range(args.corpus)]
+    totalChars = sum(len(msg.get('html', msg.get('text', ""))) for msg in corpus)
+    startTime = time.perf_counter()
+    for msg in corpus:
+        webexArchive.convert_message_text(msg)
+    seconds = time.perf_counter() - startTime
+    print(f"\n text ({args.corpus} messages, {totalChars / 1e6:.1f} MB of text)")
+    print(f" convert_message_text: {seconds:7.3f}s  ({seconds / args.corpus * 1e6:6.1f} us/message, {totalChars / seconds / 1e6:5.1f} MB/s)")
+    return {'messages': args.corpus, 'chars': totalChars, 'seconds': round(seconds, 4)}
+
+
+# ----------------------------------------------------------------------------------------
+# BENCHMARK retrieving the messages of one big space with 1..8 date ranges at the same time
+#           (historyShards). Bursts of messages with the same date test the range boundaries: the
+#           retrieved messages must be exactly all messages of the space, newest first.
+def bench_history(args):
+    webexArchive = load_script()
+    webexArchive.configure(dict({'apiRequestsPerSecond': 10000}, **args.settings))
+    space = mock_webex.MockSpace(0, args.history_messages, burst=3)
+    expected = [space.message_id(messageNr) for messageNr in reversed(range(space.messageCount))]
+    server = mock_webex.MockWebexServer([space], latency=args.latency / 1000).start()
+    api = webexArchive.WebexAPI(benchToken, server.baseURL, webexArchive.apiPoolSize, webexArchive.apiRequestsPerSecond, webexArchive.apiMaxRetries)
+    results = dict()
+    print(f"\n history (one space of {space.messageCount} messages, latency {args.latency:.0f} ms)")
+    print(f" {'shards':>7} {'seconds':>8} {'msg/s':>8} {'requests':>9}  exact order")
+    try:
+        for shards in historyShardCounts:
+            webexArchive.configure({'historyShards': shards})
+            server.reset_stats()
+            startTime = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                messageIds = [msg['id'] for page in webexArchive.get_message_pages(api, space.roomId, 900, historyStart=space.room()['created'])
+                              for msg in page]
+            seconds = time.perf_counter() - startTime
+            results[shards] = {'seconds': round(seconds, 3), 'requests': server.stats['requests'], 'exact': messageIds == expected}
+            print(f" {shards:7} {seconds:8.2f} {len(messageIds) / seconds:8.0f} {server.stats['requests']:9}  {'yes' if messageIds == expected else '**NO**'}")
+    finally:
+        server.stop()
+    return results
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that runs the mock server in its own process (so it does not share the CPU with the
+#          benchmark), yields its base URL. options: command line options of mock_webex.py
+@contextlib.contextmanager
+def mock_process(*options):
+    server = subprocess.Popen([sys.executable, "-u", os.path.join(benchDir, "mock_webex.py"), "--port", "0"] + list(options),
+                              stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        yield server.stdout.readline().split(" on ")[1].split(" ")[0]   # "Mock Webex API on <base URL> with ..."
+    finally:
+        server.terminate()
+        server.wait()
+
+
+# ----------------------------------------------------------------------------------------
+# The message pager before prefetching (reference for bench_pages): the next page is only
+# requested after the current page is processed
+def old_message_pages(api, roomId, maxCount):
+    payload = {'roomId': roomId, 'max': maxCount}
+    while True:
+        result = api.get('messages', params=payload)
+        yield result.json()["items"]
+        if "Link" not in result.headers:
+            break
+        payload = {'roomId': roomId, 'max': maxCount, 'beforeMessage': result.headers['Link'].split("beforeMessage=")[1].split(">")[0]}
+
+
+# ----------------------------------------------------------------------------------------
+# BENCHMARK pages/second of the message pager (one range, historyShards = 1) with the work a
+#           backup does for each page (spooling the page, parsing the dates), one request at a
+#           time against requesting the next page while the current one is processed
+def bench_pages(args):
+    webexArchive = load_script()
+    webexArchive.configure(dict(args.settings, apiRequestsPerSecond=10000, historyShards=1))
+    latency = args.latency or 20
+    roomId = mock_webex.MockSpace(0, 0).roomId
+    results = dict()
+    print(f"\n pages (one space of {args.history_messages} messages, latency {latency:.0f} ms)")
+    print(f" {'pager':14} {'pages':>6} {'seconds':>8} {'pages/s':>8}")
+    with mock_process("--spaces", f"1x{args.history_messages}", "--file-share", "0", "--latency", str(latency)) as baseURL:
+        api = webexArchive.WebexAPI(benchToken, baseURL, webexArchive.apiPoolSize, webexArchive.apiRequestsPerSecond, webexArchive.apiMaxRetries)
+        pagers = {'one at a time': lambda: old_message_pages(api, roomId, 900),
+                  'prefetch': lambda: webexArchive.get_message_pages(api, roomId, 900)}
+        for name, pager in pagers.items():
+            spool = webexArchive.MessageSpool()
+            pageCount = 0
+            startTime = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                for page in pager():
+                    spool.add_page(page)
+                    for msg in page:
+                        webexArchive.message_time(msg)
+                    pageCount += 1
+            seconds = time.perf_counter() - startTime
+            spool.close()
+            results[name] = {'pages': pageCount, 'seconds': round(seconds, 3), 'pagesPerSecond': round(pageCount / seconds, 2)}
+            print(f" {name:14} {pageCount:6} {seconds:8.2f} {pageCount / seconds:8.1f}")
+    return results
+
+
+benchmarks = {'endtoend': bench_endtoend, 'render': bench_render, 'history': bench_history, 'pages': bench_pages,
+              'dates': bench_dates, 'text': bench_text}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for webex-archive.py against a mock Webex API.")
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK', help="benchmarks to run: " + ", ".join(benchmarks) + " (default: all)")
+    parser.add_argument('--scenarios', default="small,medium", help="endtoend scenarios: small, medium and/or huge (default: small,medium)")
+    parser.add_argument('--latency', type=float, default=0.0, help="milliseconds the mock server adds to every response")
+    parser.add_argument('--throttle-share', type=float, default=0.0, help="share of the requests that get a 429 response")
+    parser.add_argument('--history-messages', type=int, default=30000, help="messages of the space of the history and pages benchmarks")
+    parser.add_argument('--corpus', type=int, default=20000, help="messages for the dates and text benchmarks")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help="setting of the backup, like --set spaceWorkers=1")
+    parser.add_argument('--json', metavar='FILE', help="write the results to this file")
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error(f"unknown benchmark '{name}'")
+    args.scenarios = [scenario.strip() for scenario in args.scenarios.split(",")]
+    for scenario in args.scenarios:
+        if scenario not in scenarios:
+            parser.error(f"unknown scenario '{scenario}'")
+    webexArchive = load_script()
+    args.settings = {name.strip(): webexArchive.parse_setting(name.strip(), value)
+                     for name, _, value in (setting.partition("=") for setting in args.set)}
+
+    results = {'started': datetime.datetime.now().isoformat(timespec='seconds'), 'python': sys.version.split()[0]}
+    for name in args.benchmarks or list(benchmarks):
+        results[name] = benchmarks[name](args)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "--child":
+        run_child(sys.argv[2], sys.argv[3], json.loads(sys.argv[4]))
+    else:
+        main()
@@ -25,6 +25,19 @@ import os
 import shutil # for file-download with requests
 import math   # for converting bytes to KB/MB/GB
 import string
+import threading
+import urllib.parse
+import concurrent.futures
+import email.utils   # for the Retry-After header date format
+import tempfile
+import heapq
+import itertools
+import queue
+import hashlib   # for the content-addressed avatar and attachment store
+import argparse
+import contextlib
+import csv   # for the performance report
+import configparser   # for the webex-backup.ini config file
 try:
     assert sys.version_info[0:2] >= (3, 6)
 except:
@@ -41,52 +54,78 @@ __email__ = "cas@clinical-microbiomics.com"
 __version__ = "0.6"
 __copyright__ = "Copyright (c) 2019 Cisco and/or its affiliates."
 __license__ = "Cisco Sample Code License, Version 1.1"
-sleepTime = 3
+sleepTime = 3   # default wait (seconds) after a 429 response without a Retry-After header
 version = __version__
 printPerformanceReport = False
 printErrorList = True
 currentDate = datetime.datetime.now().strftime("%x %X")
-myMemberList = dict()
-myErrorList = list()
-downloadAvatarCount = 1
+runStartTime = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")[:-4] + "Z"   # same format as Webex dates
+myEmail = ""
+myName = ""
+myDomain = ""
 
 
 if getattr(sys, 'frozen', False):
     # Program is bundled into a single executable
-    runDir = os.path.dirname(sys.executable)
-    print(f"Webex backup v{version} is being run in single-file executable mode")
-    myToken = input("Please input your personal access token: ").strip()
+    scriptDir = os.path.dirname(sys.executable)
 else:
     # Program is run as a python script
-    runDir = os.path.dirname(os.path.abspath(__file__))
-    print(f"Webex backup v{version} is being run in python script mode")
-    if len(sys.argv) == 2:
-        myToken = sys.argv[1]
-    else:
-        myToken = input("Script has either none or too many arguments to detect PAT. Please input your personal access token here: ").strip()
+    scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+runDir = scriptDir   # the backups are created here (see the 'backupFolder' setting)
+stateFolder = os.path.join(runDir, ".webex-backup")   # incremental backup state and caches
+pauseOnExit = False   # wait before closing, see leave()
 
 def beep(count): # PLAY SOUND (for errors)
     for x in range(0,count):
         print(chr(7), end="", flush=True)
     return
 
-def leave():
+def leave(exitCode=1):
     """Pyinstaller-package)d windows programs close instantly when exiting, which makes it impossible to read the message. 
     Leave() gives people time to read the reason why exit() was called, although it doesn't solve unexpected errors.
-    Those still require running the program from the command line."""
-    print("\nClosing in 30 seconds....")
-    time.sleep(30)
-    sys.exit()
+    Those still require running the program from the command line.
+    Only the single-file executable waits (pauseOnExit), and not in --batch mode: scripts and cron jobs exit right away."""
+    if pauseOnExit:
+        print("\nClosing in 30 seconds....")
+        time.sleep(30)
+    sys.exit(exitCode)
+
+# Progress output. While several spaces are backed up at the same time, log() prefixes every
+# line with the name of the space it belongs to and leaves out the '.' progress indicators.
+spaceContext = threading.local()
+printLock = threading.Lock()
+def log(text, end="\n", space=None):
+    if space is None:
+        space = getattr(spaceContext, 'space', None)
+    if space is None or spaceWorkers == 1:
+        print(text, end=end, flush=True)
+        return
+    text = text.strip()
+    if text.strip(".") == "":
+        return
+    with printLock:
+        print(f"[{space.name}] {text}", flush=True)
 
 # ----------------------------------------------------------------------------------------
 #   CONFIGURATIONS: Settings to change script behaviour.
 #   Should be fine by default, but can be adjusted
+#   Each setting can also be changed without editing the script: in the config file
+#   (webex-backup.ini next to the script, or --config FILE) or on the command line (--help).
 # ----------------------------------------------------------------------------------------
 
+# --- Which spaces to back up?
+#   '': ask (DEFAULT). In --batch mode all spaces are backed up
+#   'direct': one-on-one chats only
+#   'group': group chats only
+#   'all': one-on-one chats and group chats
+backupScope = ''
+
 # --- Download files? 
 #   'no': only show text "file attachment"
 #   'images': download images only
 #   'files': download files & images (DEFAULT)
+#   Asked at the start of the run, unless it is set in the config file or on the command line
 downloadFiles = 'files'
 
 # --- Sort messages
@@ -112,68 +151,526 @@ userAvatar = 'link'
 #   'txt': Additionally output message data as .txt file
 outputToJson = 'no'
 
+# --- Incremental backups
+#   False: every run creates a new, full backup of each space (in a new folder-01, -02... if needed) (DEFAULT)
+#   True: only fetch messages newer than the previous run and merge them into the existing backup.
+#         Spaces without activity since their last backup are skipped without any API call.
+#         The checkpoint of each space and the space manifest are kept in the '.webex-backup'
+#         folder next to the backups.
+incrementalBackup = False
+
+# --- Webex API connection
+#   apiBaseURL: base URL of the Webex REST API
+#   apiPoolSize: max. number of kept-alive connections to the API (DEFAULT: 16)
+#                should be at least spaceWorkers + downloadWorkers
+#   apiRequestsPerSecond: max. API requests per second of all workers together (DEFAULT: 20).
+#                The rate is lowered automatically when the API answers '429 Too Many Requests'.
+#   apiMaxRetries: max. number of retries of one request after a 429, connection error or timeout (DEFAULT: 10)
+#   apiConnectTimeout: seconds to wait for a connection to the API (DEFAULT: 10)
+#   apiReadTimeout: seconds to wait for (more of) a response before the request is retried (DEFAULT: 120)
+apiBaseURL = 'https://api.ciscospark.com/v1'
+apiPoolSize = 16
+apiRequestsPerSecond = 20
+apiMaxRetries = 10
+apiConnectTimeout = 10
+apiReadTimeout = 120
+
+# --- Parallel attachment downloads
+#   downloadWorkers: number of attachments fetched at the same time (DEFAULT: 8)
+#   downloadMaxPerHost: max. simultaneous requests to one host (DEFAULT: 4)
+#   downloadMaxBandwidth: max. total download speed in bytes/second, 0 = unlimited (DEFAULT)
+downloadWorkers = 8
+downloadMaxPerHost = 4
+downloadMaxBandwidth = 0
+
+# --- Parallel space backups
+#   spaceWorkers: number of spaces that are backed up at the same time (DEFAULT: 4)
+#   1: back up one space after the other
+spaceWorkers = 4
+
+# --- Parallel message history
+#   historyShards: the older messages of a big space are retrieved in this many date ranges at the
+#   same time, and put back in order (DEFAULT: 4). 1: retrieve the pages one after the other.
+#   Only spaces with an estimated 4 pages (3600 messages) or more per date range are split.
+#   Not used for incremental backups, these only retrieve the new messages.
+historyShards = 4
+
+# --- Person and membership cache
+#   The avatar URL of every person is cached in the '.webex-backup' folder and shared by all
+#   spaces, downloaded avatars are stored there once ('avatars') and linked into each backup.
+#   The members of each space are cached there too, until the space has new activity.
+#   personCacheDays: number of days a cached person is used before it is looked up again (DEFAULT: 7)
+#   0: only share the person details between the spaces of one run, don't keep any cache
+personCacheDays = 7
+
+# --- Attachment store
+#   True: downloaded attachments are stored once in the '.webex-backup/files' folder, named after
+#         their content, and hard-linked into the backup of each space. Files shared in several
+#         spaces or backed up again are only downloaded once (DEFAULT)
+#   False: downloaded attachments are only kept in the backup folder of each space
+#   (on file systems without hard links each file is copied, and so stored twice)
+#   The filename and size of every attachment are always kept in '.webex-backup/files/index.json'.
+useAttachmentStore = True
+
+# --- Backup folder
+#   '': create the backups in the folder of the script or executable (DEFAULT)
+#   or a folder, like '/home/me/webex-backups'. The '.webex-backup' state folder is kept there too.
+backupFolder = ''
+
+# --- Performance report of each run
+#   The time of each stage (per space), the number of API requests, retries, 429 responses, bytes,
+#   messages and files and the latency of the API requests are written to a report file per run,
+#   in the '.webex-backup/reports' folder: run-<start time>.json and/or .csv
+#   'json': JSON report (DEFAULT)
+#   'csv': CSV report, one line per value
+#   'both': JSON and CSV report
+#   'no': no report file
+#   (printPerformanceReport = True at the top of the script also prints the report)
+metricsReport = 'json'
+
+# the settings above: these can be changed in the config file, on the command line or with configure()
+configSettings = ['backupScope', 'downloadFiles', 'sortOldNew', 'maxTotalMessages', 'userAvatar', 'outputToJson',
+                  'incrementalBackup', 'apiBaseURL', 'apiPoolSize', 'apiRequestsPerSecond', 'apiMaxRetries', 'apiConnectTimeout',
+                  'apiReadTimeout', 'downloadWorkers', 'downloadMaxPerHost', 'downloadMaxBandwidth', 'spaceWorkers', 'historyShards',
+                  'personCacheDays', 'useAttachmentStore', 'backupFolder', 'metricsReport', 'printErrorList', 'printPerformanceReport']
+
 
 # ----------------------------------------------------------------------------------------
-#   CHECK if the configuration VALUES are valid. If not, print error messsage and exit
+#   CHECK if the configuration VALUES are valid. Returns the error messages ('' if all are valid)
+#   and sets the values that are derived from the settings.
 # ----------------------------------------------------------------------------------------
+def check_settings():
+    global maxMessageCount, msgMaxAge, maxMessageString, outputToText, runDir, stateFolder
+    goExitError = "\n\n ------------------------------------------------------------------"
+    goExit = False
 
-if isinstance(maxTotalMessages, str):
-    if 'd' in maxTotalMessages: # Example: maxTotalMessages = 60d = 60 days.
-        msgMaxAge = int(maxTotalMessages.replace("d",""))
-        maxTotalMessages = 999999
-    else:
-        maxTotalMessages = int(maxTotalMessages)
-        msgMaxAge = 0
-else:
+    maxMessageCount = 999999
     msgMaxAge = 0
+    if isinstance(maxTotalMessages, str) and re.fullmatch(r'\d+d', maxTotalMessages.strip()):
+        msgMaxAge = int(maxTotalMessages.strip()[:-1]) # Example: maxTotalMessages = 60d = 60 days.
+        maxMessageString = str(msgMaxAge) + " days"
+    else:
+        try:
+            maxMessageCount = int(maxTotalMessages)
+        except (TypeError, ValueError):
+            goExitError += "\n   **ERROR** the 'maxTotalMessages' setting must be a number or a number of days (like 60d)"
+            goExit = True
+        maxMessageString = str(maxMessageCount)
+
+    if not backupScope in ['', 'direct', 'group', 'all']:
+        goExitError += "\n   **ERROR** the 'backupScope' setting must be: '', 'direct', 'group' or 'all'"
+        goExit = True
+
+    if not downloadFiles in ['no', 'images', 'files']:
+        goExitError += "\n   **ERROR** the 'downloadFiles' setting must be: 'no', 'images' or 'files'"
+        goExit = True
+    if not userAvatar in ['no', 'link', 'download']:
+        goExitError += "\n   **ERROR** the 'userAvatar' setting must be: 'no', 'link' or 'download'"
+        goExit = True
+    if not outputToJson in ['yes', 'no', 'both', 'txt', 'json']:
+        goExitError += "\n   **ERROR** the 'outputToJson' setting must be: 'no', 'yes', 'both', 'txt' or 'json'."
+        goExit = True
+    if outputToJson in ['txt', 'yes', 'both']:
+        outputToText = True
+    else:
+        outputToText = False
+
+    if not incrementalBackup in [True, False]:
+        goExitError += "\n   **ERROR** the 'incrementalBackup' setting must be: True or False"
+        goExit = True
+    if not isinstance(apiPoolSize, int) or apiPoolSize < 1:
+        goExitError += "\n   **ERROR** the 'apiPoolSize' setting must be a number of 1 or higher"
+        goExit = True
+
+    if not isinstance(apiRequestsPerSecond, (int, float)) or apiRequestsPerSecond <= 0:
+        goExitError += "\n   **ERROR** the 'apiRequestsPerSecond' setting must be a number higher than 0"
+        goExit = True
+    if not isinstance(apiMaxRetries, int) or apiMaxRetries < 0:
+        goExitError += "\n   **ERROR** the 'apiMaxRetries' setting must be 0 or a higher number"
+        goExit = True
+    for name, timeout in [('apiConnectTimeout', apiConnectTimeout), ('apiReadTimeout', apiReadTimeout)]:
+        if not isinstance(timeout, (int, float)) or timeout <= 0:
+            goExitError += f"\n   **ERROR** the '{name}' setting must be a number of seconds higher than 0"
+            goExit = True
+    if not isinstance(spaceWorkers, int) or spaceWorkers < 1:
+        goExitError += "\n   **ERROR** the 'spaceWorkers' setting must be a number of 1 or higher"
+        goExit = True
+    if not isinstance(historyShards, int) or historyShards < 1:
+        goExitError += "\n   **ERROR** the 'historyShards' setting must be a number of 1 or higher"
+        goExit = True
+    if not isinstance(downloadWorkers, int) or downloadWorkers < 1:
+        goExitError += "\n   **ERROR** the 'downloadWorkers' setting must be a number of 1 or higher"
+        goExit = True
+    if not isinstance(downloadMaxPerHost, int) or downloadMaxPerHost < 1:
+        goExitError += "\n   **ERROR** the 'downloadMaxPerHost' setting must be a number of 1 or higher"
+        goExit = True
+    if not isinstance(downloadMaxBandwidth, int) or downloadMaxBandwidth < 0:
+        goExitError += "\n   **ERROR** the 'downloadMaxBandwidth' setting must be 0 (unlimited) or a number of bytes/second"
+        goExit = True
+
+    if not isinstance(personCacheDays, (int, float)) or personCacheDays < 0:
+        goExitError += "\n   **ERROR** the 'personCacheDays' setting must be 0 or a number of days"
+        goExit = True
+
+    if not useAttachmentStore in [True, False]:
+        goExitError += "\n   **ERROR** the 'useAttachmentStore' setting must be: True or False"
+        goExit = True
+
+    if not metricsReport in ['no', 'json', 'csv', 'both']:
+        goExitError += "\n   **ERROR** the 'metricsReport' setting must be: 'no', 'json', 'csv' or 'both'"
+        goExit = True
+
+    if backupFolder == '':
+        runDir = scriptDir
+    else:
+        runDir = os.path.abspath(os.path.expanduser(backupFolder))
+        if os.path.exists(runDir) and not os.path.isdir(runDir):
+            goExitError += "\n   **ERROR** the 'backupFolder' setting must be a folder"
+            goExit = True
+    stateFolder = os.path.join(runDir, ".webex-backup")
 
-goExitError = "\n\n ------------------------------------------------------------------"
-goExit = False
-
-if not downloadFiles in ['no', 'images', 'files']:
-    goExitError += "\n   **ERROR** the 'downloadFiles' setting must be: 'no', 'images' or 'files'"
-    goExit = True
-if not userAvatar in ['no', 'link', 'download']:
-    goExitError += "\n   **ERROR** the 'userAvatar' setting must be: 'no', 'link' or 'download'"
-    goExit = True
-if not outputToJson in ['yes', 'no', 'both', 'txt', 'json']:
-    goExitError += "\n   **ERROR** the 'outputToJson' setting must be: 'no', 'yes', 'both', 'txt' or 'json'."
-if outputToJson in ['txt', 'yes', 'both']:
-    outputToText = True
-else:
-    outputToText = False
+    if goExit:
+        return goExitError + "\n ------------------------------------------------------------------\n\n"
+    return ""
 
-if goExit:   
-    print(goExitError + "\n ------------------------------------------------------------------\n\n")
-    beep(3)
-    leave()
+check_settings()   # the values derived from the default settings
 
 
 # ----------------------------------------------------------------------------------------
-#   PERSONAL ACCESS TOKEN: Gather the PAT from the command line argument.
+#   FUNCTIONS
 # ----------------------------------------------------------------------------------------
 
-# if len(sys.argv) < 2:
-#     print("You ran the python script without the token. Please run 'python webex-teams-space-archive.py [your_personal_access_token_here]'.")
-#     print("You can generate this token by logging in on 'https://developer.webex.com/docs/api/getting-started' and scrolling down to 'Your Personal Access Token'.")
-#     leave()
-# if len(sys.argv) > 2:
-#     print("You have too many arguments with your python script. Please run webex-teams-space-archive.py [your_personal_access_token_here]")
-#     print("and make sure there are no accidental spaces in your PAT.")
-#     leave()
+# ----------------------------------------------------------------------------------------
+# CLASS performance metrics of a run, shared by all threads. Everything is kept per space (the
+#       space of the thread, see log(); "" outside a space) and in total:
+#       - spans: time of the stages, with start(name)/stop() or 'with span(name):'. A span started
+#         inside another span of the same thread is named after both ("backup space/get messages").
+#       - counters: count(name, amount), like the API requests, bytes downloaded and 429 responses
+#       - histograms: observe(name, seconds), like the latency of the API requests, counted
+#         in the latencyBuckets (seconds)
+#       report() is the text version, write_report() writes the JSON and/or CSV report of the run.
+latencyBuckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.startTime = time.perf_counter()
+        self.spans = dict()        # space name -> {span name: [count, total seconds, max seconds]}
+        self.counters = dict()     # space name -> {counter name: value}
+        self.histograms = dict()   # name -> [count, sum, min, max, count per bucket]
+
+    @staticmethod
+    def space_name():
+        space = getattr(spaceContext, 'space', None)
+        return space.name if space is not None else ""
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = list()
+        return self.local.stack
+
+    def start(self, name):
+        stack = self.stack()
+        if len(stack) > 0:
+            name = stack[-1][0] + "/" + name
+        stack.append((name, time.perf_counter()))
+
+    def stop(self):
+        name, startTime = self.stack().pop()
+        duration = time.perf_counter() - startTime
+        with self.lock:
+            span = self.spans.setdefault(self.space_name(), dict()).setdefault(name, [0, 0.0, 0.0])
+            span[0] += 1
+            span[1] += duration
+            span[2] = max(span[2], duration)
+
+    # spans that were started but not stopped inside this span (a stage that returned early) are left out
+    @contextlib.contextmanager
+    def span(self, name):
+        stack = self.stack()
+        depth = len(stack)
+        self.start(name)
+        try:
+            yield
+        finally:
+            del stack[depth + 1:]
+            self.stop()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            counters = self.counters.setdefault(self.space_name(), dict())
+            counters[name] = counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        bucket = next((index for index, limit in enumerate(latencyBuckets) if value <= limit), len(latencyBuckets))
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0, 0.0, value, value, [0] * (len(latencyBuckets) + 1)]
+            histogram[0] += 1
+            histogram[1] += value
+            histogram[2] = min(histogram[2], value)
+            histogram[3] = max(histogram[3], value)
+            histogram[4][bucket] += 1
+
+    # the upper limit of the bucket with the p-th percentile (the max. value for the last bucket)
+    @staticmethod
+    def percentile(histogram, p):
+        rank = math.ceil(histogram[0] * p / 100)
+        seen = 0
+        for index, bucketCount in enumerate(histogram[4]):
+            seen += bucketCount
+            if seen >= rank:
+                return latencyBuckets[index] if index < len(latencyBuckets) else histogram[3]
+        return histogram[3]
+
+    def totals(self):
+        with self.lock:
+            spans = dict()
+            counters = dict()
+            for spaceSpans in self.spans.values():
+                for name, (spanCount, total, longest) in spaceSpans.items():
+                    span = spans.setdefault(name, [0, 0.0, 0.0])
+                    span[0] += spanCount
+                    span[1] += total
+                    span[2] = max(span[2], longest)
+            for spaceCounters in self.counters.values():
+                for name, value in spaceCounters.items():
+                    counters[name] = counters.get(name, 0) + value
+        return spans, counters
+
+    def histogram_summary(self, histogram):
+        return {'count': histogram[0], 'sum': round(histogram[1], 4), 'min': round(histogram[2], 4), 'max': round(histogram[3], 4),
+                'mean': round(histogram[1] / histogram[0], 4), 'p50': self.percentile(histogram, 50),
+                'p95': self.percentile(histogram, 95), 'p99': self.percentile(histogram, 99),
+                'buckets': dict(zip([str(limit) for limit in latencyBuckets] + ["+Inf"], histogram[4]))}
+
+    def to_dict(self, spaces=(), extra=None):
+        def spans_dict(spans):
+            return {name: {'count': span[0], 'seconds': round(span[1], 4), 'max': round(span[2], 4)} for name, span in sorted(spans.items())}
+        spans, counters = self.totals()
+        with self.lock:
+            report = dict(extra or {})
+            report['seconds'] = round(time.perf_counter() - self.startTime, 3)
+            report['spans'] = spans_dict(spans)
+            report['counters'] = dict(sorted(counters.items()))
+            report['histograms'] = {name: self.histogram_summary(histogram) for name, histogram in sorted(self.histograms.items())}
+            report['spaces'] = [{'name': space.name, 'id': space.roomId, 'result': space.result, 'errors': len(space.errorList),
+                                 'spans': spans_dict(self.spans.get(space.name, {})), 'counters': dict(sorted(self.counters.get(space.name, {}).items()))}
+                                for space in spaces]
+        return report
+
+    def report(self):
+        spans, counters = self.totals()
+        text = f"Performance Report - Space Archive Script ({time.perf_counter() - self.startTime:.2f}s)\n "
+        text += "----------------------------------------------------"
+        for name, (spanCount, total, longest) in sorted(spans.items(), key=lambda item: -item[1][1]):
+            text += f"\n {total:8.2f}s  {spanCount:5}x  max {longest:6.2f}s  {name}"
+        for name, value in sorted(counters.items()):
+            text += f"\n {value:>10}  {name}"
+        with self.lock:
+            for name, histogram in sorted(self.histograms.items()):
+                text += f"\n {name}: {histogram[0]} requests - mean {histogram[1] / histogram[0]:.3f}s - p50 <= {self.percentile(histogram, 50)}s - p95 <= {self.percentile(histogram, 95)}s - max {histogram[3]:.3f}s"
+        return text
+
+    # writes <name>.json and/or <name>.csv (reportType 'json', 'csv' or 'both') in folder.
+    # The CSV file has one line per metric: space, type (span/counter/histogram), name, count, total, max, p50, p95, p99
+    def write_report(self, folder, name, reportType, spaces=(), extra=None):
+        os.makedirs(folder, exist_ok=True)
+        report = self.to_dict(spaces, extra)
+        filenames = list()
+        if reportType in ['json', 'both']:
+            filenames.append(os.path.join(folder, name + ".json"))
+            write_json_file(report, filenames[-1])
+        if reportType in ['csv', 'both']:
+            filenames.append(os.path.join(folder, name + ".csv"))
+            rows = list()
+            for spaceName, values in [("", report)] + [(space['name'], space) for space in report['spaces']]:
+                for spanName, span in values['spans'].items():
+                    rows.append([spaceName, "span", spanName, span['count'], span['seconds'], span['max'], "", "", ""])
+                for counterName, value in values['counters'].items():
+                    rows.append([spaceName, "counter", counterName, "", value, "", "", "", ""])
+            for histogramName, histogram in report['histograms'].items():
+                rows.append(["", "histogram", histogramName, histogram['count'], histogram['sum'], histogram['max'], histogram['p50'], histogram['p95'], histogram['p99']])
+            with open(filenames[-1], 'w', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(["space", "type", "name", "count", "total", "max", "p50", "p95", "p99"])
+                writer.writerows(rows)
+        return filenames
+
+metrics = Metrics()
 
-# myToken = sys.argv[1]
 
+# ----------------------------------------------------------------------------------------
+# CLASS request scheduler shared by all workers: a token bucket that allows 'rate' requests per
+#       second. A 429 response pauses all workers for the Retry-After time and halves the rate,
+#       every successful request raises it again a little (up to maxRate).
+#       Counts retries, 429 responses and the time workers spent waiting.
+class RateLimiter:
+    def __init__(self, maxRate):
+        self.maxRate = maxRate
+        self.minRate = min(maxRate, 0.5)
+        self.rate = maxRate
+        self.tokens = 1.0
+        self.lastCheck = time.monotonic()
+        self.pausedUntil = 0.0
+        self.lock = threading.Lock()
+        self.requestCount = 0
+        self.retryCount = 0
+        self.throttledCount = 0
+        self.timeThrottled = 0.0
+
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.pausedUntil:
+                    waitTime = self.pausedUntil - now
+                else:
+                    self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.lastCheck) * self.rate)
+                    self.lastCheck = now
+                    if self.tokens >= 1.0:
+                        self.tokens -= 1.0
+                        self.requestCount += 1
+                        return
+                    waitTime = (1.0 - self.tokens) / self.rate
+                self.timeThrottled += waitTime
+            time.sleep(waitTime)
+
+    def throttle(self, retryAfter):
+        with self.lock:
+            self.throttledCount += 1
+            self.retryCount += 1
+            self.rate = max(self.minRate, self.rate / 2)
+            self.tokens = 0.0
+            self.pausedUntil = max(self.pausedUntil, time.monotonic() + retryAfter)
+
+    def retry(self):
+        with self.lock:
+            self.retryCount += 1
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + self.maxRate / 100)
+
+    def report(self):
+        return f"API requests: {self.requestCount} - retries: {self.retryCount} - 429 responses: {self.throttledCount} - time throttled: {self.timeThrottled:.1f}s"
 
-if len(myToken) < 55:
-    print("-----------------   **ERROR** Your personal access token is too short.  -----------------")
-    leave()
 
+# ----------------------------------------------------------------------------------------
+# CLASS shared Webex API client. One pooled HTTP session that keeps connections alive and
+#       sets the auth headers once, used by every Webex API call in this script.
+#       Endpoints can be given relative to apiBaseURL ('messages') or as a full URL.
+#       All requests go through the rate limiter; 429 responses, connection errors and timeouts are
+#       retried (max. maxRetries times), so callers never see a 429 unless retries run out.
+#       The requests, retries and the latency per endpoint ('latency messages') are counted in metrics.
+class WebexAPI:
+    def __init__(self, token, baseURL, poolSize, requestsPerSecond, maxRetries, timeout=(10, 120)):
+        self.baseURL = baseURL.rstrip('/')
+        self.rateLimiter = RateLimiter(requestsPerSecond)
+        self.maxRetries = maxRetries
+        self.timeout = timeout   # (connect, read) seconds: a stalled connection never hangs a worker
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Authorization': 'Bearer ' + token, 'content-type': 'application/json; charset=utf-8'})
+
+    def url(self, endpoint):
+        if endpoint.startswith('http'):
+            return endpoint
+        return self.baseURL + '/' + endpoint
+
+    # name of the endpoint for the metrics: 'messages', 'contents' ('other' for URLs outside the API)
+    @staticmethod
+    def endpoint_name(url):
+        path = urllib.parse.urlsplit(url).path.strip('/').split('/')
+        if len(path) >= 2 and re.fullmatch(r'v\d+', path[0]):
+            return path[1]
+        return "other"
+
+    def request(self, method, endpoint, **kwargs):
+        attempt = 0
+        url = self.url(endpoint)
+        kwargs.setdefault('timeout', self.timeout)
+        while True:
+            self.rateLimiter.wait()
+            requestStart = time.perf_counter()
+            try:
+                result = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                metrics.count("timeouts" if isinstance(e, requests.exceptions.Timeout) else "connection errors")
+                if attempt >= self.maxRetries:
+                    raise
+                attempt += 1
+                metrics.count("retries")
+                self.rateLimiter.retry()
+                time.sleep(min(2 ** attempt, 60))
+                continue
+            metrics.count("API requests")
+            metrics.observe("latency " + self.endpoint_name(url), time.perf_counter() - requestStart)
+            if result.status_code != 429 or attempt >= self.maxRetries:
+                if result.status_code != 429:
+                    self.rateLimiter.success()
+                return result
+            retryAfter = retry_after_seconds(result.headers.get('Retry-After'))
+            result.close()
+            log("          Code 429, waiting for : " + str(retryAfter) + " seconds")
+            self.rateLimiter.throttle(retryAfter)
+            metrics.count("429 responses")
+            metrics.count("retries")
+            attempt += 1
+
+    def get(self, endpoint, **kwargs):
+        return self.request('GET', endpoint, **kwargs)
+
+    def head(self, endpoint, **kwargs):
+        return self.request('HEAD', endpoint, **kwargs)
 
 
 # ----------------------------------------------------------------------------------------
-#   FUNCTIONS
+# FUNCTION that reads the Retry-After header of a 429 response (seconds or an HTTP date)
+def retry_after_seconds(retryAfter):
+    if retryAfter is None:
+        return sleepTime
+    try:
+        return max(0.0, float(retryAfter))
+    except ValueError:
+        pass
+    try:
+        retryDate = email.utils.parsedate_to_datetime(retryAfter)
+        return max(0.0, (retryDate - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return sleepTime
+
+
 # ----------------------------------------------------------------------------------------
+# FUNCTION that sends the request of one page of a list API (rooms, memberships, messages) in a
+#          thread of pagePool: the pagers request the next page before they process the current one,
+#          so the page is on its way while they (and their caller) work. Returns a Future of
+#          (response, items of the page). The JSON is parsed once, in the thread. items is None
+#          for a 401 response (invalid token), other errors are raised by the Future (a response
+#          without JSON items, like an error status with a JSON body, as a ValueError, not as a
+#          requests exception).
+pagePool = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix="page")
+
+def request_page(api, endpoint, payload):
+    space = getattr(spaceContext, 'space', None)
+
+    def fetch():
+        spaceContext.space = space   # for the log and metrics of the space
+        try:
+            result = api.get(endpoint, params=payload)
+            if result.status_code == 401:
+                return result, None
+            content = json.loads(result.content)
+            if not isinstance(content, dict) or "items" not in content:
+                raise ValueError(f"{result.status_code} response without items: {result.text[:200]}")
+            return result, content["items"]
+        finally:
+            spaceContext.space = None
+    return pagePool.submit(fetch)
 
 
 # ----------------------------------------------------------------------------------------
@@ -189,160 +686,758 @@ def timeDeltaWithUTC():
        UTChourDelta = round((dateUTC-dateNOW).seconds / 3600, 1) * -1
     return UTChourDelta
 
+UTChourDelta = timeDeltaWithUTC()
+epochStart = datetime.datetime(1970, 1, 1)
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that parses a Webex date ("2018-02-01T13:45:10.123Z", always UTC). Slicing the fixed
+#          format is a lot faster than strptime, which is only used for other formats.
+def parse_webex_date(inputdate):
+    if len(inputdate) == 24 and inputdate[10] == "T" and inputdate[19] == "." and inputdate[23] == "Z":
+        try:
+            return datetime.datetime(int(inputdate[0:4]), int(inputdate[5:7]), int(inputdate[8:10]), int(inputdate[11:13]),
+                                     int(inputdate[14:16]), int(inputdate[17:19]), int(inputdate[20:23]) * 1000)
+        except ValueError:
+            pass
+    return datetime.datetime.strptime(inputdate, "%Y-%m-%dT%H:%M:%S.%fZ")
+
+# and the other way around: a (UTC) datetime in the Webex date format
+def webex_date(date):
+    return date.strftime("%Y-%m-%dT%H:%M:%S.") + f"{date.microsecond // 1000:03d}Z"
+
+
+# ----------------------------------------------------------------------------------------
+# CLASS with the parsed 'created' date of a message: UTC and local date/time, epoch and the
+#       year/month values used in the lay-out and statistics (taken from the UTC date).
+monthNames = [datetime.date(2000, monthNr, 1).strftime("%b") for monthNr in range(1, 13)]
+
+class MessageTime:
+    __slots__ = ('utc', 'local', 'epoch', 'year', 'month', 'monthNr', 'monthKey')
+
+    def __init__(self, created):
+        self.utc = parse_webex_date(created)
+        self.local = self.utc + datetime.timedelta(hours=UTChourDelta)
+        self.epoch = (self.utc - epochStart).total_seconds()
+        self.year = str(self.utc.year)
+        self.month = monthNames[self.utc.month - 1]
+        self.monthNr = f"{self.utc.month:02d}"
+        self.monthKey = self.year + " - " + self.monthNr + "-" + self.month
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION returns the MessageTime of a message. The date is parsed once and stored with the
+#          message (key '_time', left out of all JSON output by message_json)
+def message_time(msg):
+    msgTime = msg.get('_time')
+    if msgTime is None:
+        msgTime = msg['_time'] = MessageTime(msg['created'])
+    return msgTime
+
+def message_json(msg):
+    if '_time' in msg:
+        msg = {key: value for key, value in msg.items() if key != '_time'}
+    return json.dumps(msg)
+
+
 # ----------------------------------------------------------------------------------------
 # FUNCTION convert date to format displayed with each message. Used in HTML generation.
-#          This function checks the timezone difference between you and UTC and updates the
-#          message date/time so the actual times for your timezone are displayed.
-def convertDate(inputdate, hourdelta):
-    FMT = "%Y-%m-%dT%H:%M:%S.%fZ"
-    dateMSG = datetime.datetime.strptime(inputdate, FMT)
-    dateMSGnew = dateMSG + datetime.timedelta(hours=hourdelta)
-    return datetime.datetime.strftime(dateMSGnew, "%A, %H:%M      (%b %d, %Y)")
+#          The message date/time is shown in your local timezone (see UTChourDelta).
+def convertDate(msg):
+    return message_time(msg).local.strftime("%A, %H:%M      (%b %d, %Y)")
 
 
 # ----------------------------------------------------------------------------------------
 # FUNCTION used in the lay-out and statistics HTML generation.
-#          takes a date and outputs "2018" (year), "Feb" (short month), "2" (month number)
-def get_monthday(inputdate):
-    myyear = datetime.datetime.strptime(inputdate, "%Y-%m-%dT%H:%M:%S.%fZ").strftime("%Y")
-    mymonth = datetime.datetime.strptime(inputdate, "%Y-%m-%dT%H:%M:%S.%fZ").strftime("%b")
-    mymonthnr = datetime.datetime.strptime(inputdate, "%Y-%m-%dT%H:%M:%S.%fZ").strftime("%m")
-    return myyear, mymonth, mymonthnr
+#          takes a message and outputs "2018" (year), "Feb" (short month), "02" (month number)
+def get_monthday(msg):
+    msgTime = message_time(msg)
+    return msgTime.year, msgTime.month, msgTime.monthNr
 
 
 # ----------------------------------------------------------------------------------------
-# FUNCTION that returns the time difference between 2 dates in seconds
+# FUNCTION that returns the time difference between 2 messages in seconds
 #           (to check if msgs from 1 author were send within 60 seconds: no new msg header)
-def timedifference(newdate, previousdate):
-    FMT = "%Y-%m-%dT%H:%M:%S.%fZ"
-    tdelta = datetime.datetime.strptime(newdate, FMT) - datetime.datetime.strptime(previousdate, FMT)
+def timedifference(newmsg, previousmsg):
+    tdelta = message_time(newmsg).utc - message_time(previousmsg).utc
     return tdelta.seconds
 
 
 # ----------------------------------------------------------------------------------------
-# FUNCTION that returns the time difference between the msg-date and today (# of days)
-#           (used when setting max messages to XX days instead of number of msgs)
-def timedifferencedays(msgdate):
-    FMT = "%Y-%m-%dT%H:%M:%S.%fZ"
-    tdelta = datetime.datetime.today() - datetime.datetime.strptime(msgdate,FMT)
-    return tdelta.days
-
-
-# ----------------------------------------------------------------------------------------
-# FUNCTION finds URLs in message text + convert to a hyperlink. Used in HTML generation.
-def convertURL(inputtext):
-    outputtext = inputtext
-    urls = re.findall('(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&!:/~+#-]*[\w@?^=%&/~+#-])?', inputtext)
-    if len(urls) > 0:
-        for replaceThisURL in urls:
-            replaceNewURL = replaceThisURL[0] + "://" + replaceThisURL[1] + replaceThisURL[2]
-            outputtext = outputtext.replace(replaceNewURL, "<a href='" + str(replaceNewURL) + "' target='_blank'>" + str(replaceNewURL) + "</a>")
-    return outputtext
+# FUNCTION that returns the cutoff date of maxTotalMessages in days (msgMaxAge) as a Webex date:
+#          messages created at or before it are more than msgMaxAge days old and are left out.
+#          Webex dates of the same format compare as strings, so no message date is parsed.
+#          '' if there is no day limit.
+def age_cutoff():
+    if msgMaxAge == 0:
+        return ""
+    return webex_date(datetime.datetime.utcnow() - datetime.timedelta(days=msgMaxAge + 1))
+
+# binary search: the index of the first message created at or before the cutoff in a page
+# (newest first), len(messages) if there is none
+def first_message_before(messages, cutoff):
+    low, high = 0, len(messages)
+    while low < high:
+        middle = (low + high) // 2
+        if messages[middle]['created'] <= cutoff:
+            high = middle
+        else:
+            low = middle + 1
+    return low
 
 
 # ----------------------------------------------------------------------------------------
-# FUNCTION to convert all Markdown URL's [linktext](http://link.com) to clickable links
-def convertMarkdownURL(msgtext, whichreplace):
-    try:
-        if whichreplace == 1:
-            regex = r"alt=(.*?)event\);\""
-        if whichreplace == 2:
-            regex = r"\ onClick=(.*?)event\)\;\""
-        matches = re.finditer(regex, msgtext, re.MULTILINE)
-        matchDict = dict()  # create dictionary with match details so I can _reverse_ replace
-        for matchNum, match in enumerate(matches, start=1):
-            matchDict[matchNum] = [match.start(),match.end()]
-        for i in sorted(matchDict.keys(), reverse=True):
-            msgtext = msgtext[0:matchDict[i][0]] + " target='_blank'" + msgtext[matchDict[i][1]:]
-    except:
-        test = msgtext
-        print(" **ERROR** replacing markdown URL's in text: " + msgtext)
-    return msgtext
+# FUNCTION converts the text of a message to the HTML shown in the backup, in a single pass
+#          with one precompiled regex:
+#           - URLs become clickable links (not in 'html' tags or existing links)
+#           - Markdown links [linktext](www.cisco.com) open in a new tab
+#           - @mentions of people and groups mentioned in the message are highlighted
+mentionPatterns = r'(?P<person><spark-mention data-object-type="person" data-object-id="(?P<personId>[^"]*)">)' \
+                  r'|(?P<group><spark-mention data-object-type="groupMention" data-group-type="(?P<groupType>[^"]*)">)' \
+                  r'|(?P<close></spark-mention>)'
+urlPattern = r'(?P<url>(?:http|ftp|https)://[\w_-]+(?:(?:\.[\w_-]+)+)(?:[\w.,@?^=%&!:/~+#-]*[\w@?^=%&/~+#-])?)'
+textPattern = re.compile(mentionPatterns + '|' + urlPattern)
+htmlPattern = re.compile(mentionPatterns + r'|(?P<tag><[^>]*>)|' + urlPattern)
+markdownPattern = re.compile(mentionPatterns + r'|(?P<markdown>(?:alt=| onClick=).*?event\);")')
+htmlTagPattern = re.compile(r'<.*?>')   # strips the HTML for the .txt output
+
+def convert_message_text(msg):
+    if 'html' in msg:
+        inputtext = str(msg['html'])
+        if "sparkBase.clickEventHandler(event)" in inputtext:
+            pattern = markdownPattern
+        else:
+            pattern = htmlPattern
+    elif 'text' in msg:
+        inputtext = str(msg['text'])
+        pattern = textPattern
+    else:
+        return ""
+    mentionedPeople = set(msg.get('mentionedPeople', []))
+    mentionedGroups = set(msg.get('mentionedGroups', []))
+    hasMentions = 'mentionedPeople' in msg or 'mentionedGroups' in msg
+    outputtext = list()
+    position = 0
+    inLink = False
+    for match in pattern.finditer(inputtext):
+        matchType = match.lastgroup
+        replacement = match.group()
+        if matchType == 'url':
+            if not inLink:
+                replacement = "<a href='" + replacement + "' target='_blank'>" + replacement + "</a>"
+        elif matchType == 'tag':
+            tagName = replacement[1:].split(None, 1)[0].rstrip(">").lower() if len(replacement) > 2 else ""
+            if tagName == "a":
+                inLink = True
+            elif tagName == "/a":
+                inLink = False
+        elif matchType == 'markdown':
+            replacement = " target='_blank'"
+        elif matchType == 'person':
+            if match.group('personId') in mentionedPeople:
+                replacement = "<span style='color:red;display:inline;'>@"
+        elif matchType == 'group':
+            if match.group('groupType') in mentionedGroups:
+                replacement = "<span style='color:red;display:inline;'>@"
+        elif hasMentions:   # close
+            replacement = "</span>"
+        outputtext.append(inputtext[position:match.start()])
+        outputtext.append(replacement)
+        position = match.end()
+    outputtext.append(inputtext[position:])
+    return "".join(outputtext)
 
 
 # ----------------------------------------------------------------------------------------
 # FUNCTION that retrieves a list of Space members (displayName + email address)
-def get_memberships(mytoken, myroom, maxmembers):
-    headers = {'Authorization': 'Bearer ' + mytoken, 'content-type': 'application/json; charset=utf-8'}
-    payload = {'roomId': myroom, 'max': maxmembers}
+#          Returns (members, complete): complete is False when a page could not be retrieved,
+#          the members are then only those of the pages before it.
+def get_memberships(api, myroom, maxmembers):
+    page = request_page(api, 'memberships', {'roomId': myroom, 'max': maxmembers})
     resultjson = list()
-    while True:
-        try:
-            result = requests.get('https://api.ciscospark.com/v1/memberships', headers=headers, params=payload)
-            if "Link" in result.headers:  # there's MORE members
+    try:
+        while page is not None:
+            result, items = page.result()
+            page = None
+            if items is None:
+                raise ValueError("401 response: invalid access token")
+            if "Link" in result.headers:  # there's MORE members: request the next page first
                 headerLink = result.headers["Link"]
                 myCursor = headerLink[headerLink.find("cursor=")+len("cursor="):headerLink.rfind("==>")]
-                payload = {'roomId': myroom, 'max': maxmembers, 'cursor': myCursor}
-                resultjson += result.json()["items"]
-                continue
-            else:
-                resultjson += result.json()["items"]
-                print("          People in this space: " + str(len(resultjson)))
-                break
-        except requests.exceptions.RequestException as e: # A serious problem, like an SSLError or InvalidURL
-            if e.status_code == 429:
-                print("          Code 429, waiting for : " + str(sleepTime) + " seconds: ", end='', flush=True)
-                for x in range(0, sleepTime):
-                    time.sleep(1)
-                    print(".", end='', flush=True) # Progress indicator
-            else:
-                break
-    return resultjson
+                page = request_page(api, 'memberships', {'roomId': myroom, 'max': maxmembers, 'cursor': myCursor})
+            resultjson += items
+        log("          People in this space: " + str(len(resultjson)))
+    except (requests.exceptions.RequestException, ValueError) as e: # A serious problem, like an SSLError or InvalidURL
+        log("          **ERROR** getting members: " + str(e))
+        return resultjson, False
+    return resultjson, True
 
 
 # ----------------------------------------------------------------------------------------
-# FUNCTION that retrieves all space messages - testing error 429 catching
-def get_messages(mytoken, myroom, myMaxMessages):
-    global maxTotalMessages
-    headers = {'Authorization': 'Bearer ' + mytoken, 'content-type': 'application/json; charset=utf-8'}
-    payload = {'roomId': myroom, 'max': myMaxMessages}
-    resultjsonmessages = list()
+# CLASS cache of the members of every space (email -> displayName), kept between runs in
+#       memberships.json. The members of a space are used until its lastActivity changes.
+#       memberships.json: roomId -> {'lastActivity': ..., 'count': # members, 'members': {email: name}}
+class MembershipCache:
+    def __init__(self, folder, persist):
+        self.folder = folder
+        self.persist = persist
+        self.lock = threading.Lock()
+        self.rooms = dict()
+        self.cachedCount = 0
+        self.lookupCount = 0
+        if persist:
+            try:
+                with open(os.path.join(folder, "memberships.json"), 'r', encoding='utf-8') as f:
+                    self.rooms = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    # returns (email -> displayName, # of members) of a space
+    def get_members(self, api, roomId, lastActivity):
+        with self.lock:
+            room = self.rooms.get(roomId)
+        if room is not None and lastActivity != "" and room['lastActivity'] == lastActivity:
+            log("          People in this space: " + str(room['count']) + " (cached)")
+            with self.lock:
+                self.cachedCount += 1
+            return dict(room['members']), room['count']
+        memberList = dict()
+        myMembers, complete = get_memberships(api, roomId, 500)
+        for members in myMembers:
+            try:
+                memberList[str(members['personEmail'])] = str(members['personDisplayName'])
+            except Exception as e:  # IF there's no personDisplayName, use email
+                memberList[str(members['personEmail'])] = str(members['personEmail'])
+        with self.lock:
+            self.lookupCount += 1
+            if lastActivity != "" and complete and len(myMembers) > 0:   # never cache a partial list
+                self.rooms[roomId] = {'lastActivity': lastActivity, 'count': len(myMembers), 'members': memberList}
+        return dict(memberList), len(myMembers)
+
+    def save(self):
+        if self.persist:
+            os.makedirs(self.folder, exist_ok=True)
+            with self.lock:
+                rooms = dict(self.rooms)
+            write_json_file(rooms, os.path.join(self.folder, "memberships.json"))
+
+    def report(self):
+        return f"Member lists: {self.lookupCount} retrieved - {self.cachedCount} from cache"
+
+
+# ----------------------------------------------------------------------------------------
+# CLASS exception of get_message_pages() for a space without any messages
+class EmptySpace(Exception):
+    pass
+
+
+# ----------------------------------------------------------------------------------------
+# CLASS exception that stops the backup of one space (in a worker thread), the other spaces
+#       continue. leave() is only used in the main thread: it exits the whole program.
+class SpaceFailed(Exception):
+    pass
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that retrieves the messages of a space page by page: a generator that yields each
+#          page (newest messages first) as soon as it arrives, so the whole space is never in memory.
+#          Stops at maxTotalMessages, at msgMaxAge days or, with a checkpoint (incremental backup),
+#          at the last message of the previous run.
+#          historyStart (the date the space was created) allows fetch_message_pages() to retrieve
+#          the history of a big space in date ranges at the same time (from historyStart or the
+#          msgMaxAge cutoff).
+#          Raises EmptySpace if the first page is empty: the space has no messages at all.
+def get_message_pages(api, myroom, myMaxMessages, checkpoint=None, pageJournal=None, historyStart=""):
+    cursor = None
     messageCount = 0
-    while True:
-        try:
-            result = requests.get('https://api.ciscospark.com/v1/messages', headers=headers, params=payload)
-            messageCount += len(result.json()["items"])
-            if "Link" in result.headers and messageCount < maxTotalMessages:  # there's MORE messages
-                resultjsonmessages = resultjsonmessages + result.json()["items"]
-                # When retrieving multiple batches _check_ if the last message retrieved
-                #      is _OLDER_ than the configured max msg age (in the .ini). If yes: trim results to the max age.
-                if msgMaxAge != 0:
-                    msgAge = timedifferencedays(result.json()["items"][-1]["created"])
-                    if msgAge > msgMaxAge:
-                        print("          max messages reached (>" + str(msgMaxAge) + " days old)")
-                        # NOW I set maxTotalMessages to the last msg index that should be included, based on msg age in days.
-                        maxTotalMessages = next((index for (index,d) in enumerate(resultjsonmessages) if timedifferencedays(d["created"]) > msgMaxAge), 99999)
-                        print(str(maxTotalMessages))
-                        break
-                myBeforeMessage = result.headers.get('Link').split("beforeMessage=")[1].split(">")[0]
-                payload = {'roomId': myroom, 'max': myMaxMessages, 'beforeMessage': myBeforeMessage}
-                continue
-            else:
-                resultjsonmessages = resultjsonmessages + result.json()["items"]
-                if msgMaxAge != 0:
-                    msgAge = timedifferencedays(result.json()["items"][-1]["created"])
-                    lastMsgLocation = next((index for (index,d) in enumerate(resultjsonmessages) if timedifferencedays(d["created"]) > msgMaxAge), 99999)
-                    maxTotalMessages = lastMsgLocation
-                print("          Total messages: " + str(messageCount))
-                if "Link" in result.headers:   # There ARE more messages but the maxTotalMessages has been reached
-                    print("          Reached configured maximum # messages (" + str(maxTotalMessages) + ")")
+    moreMessages = True
+    if pageJournal is not None:
+        # pages retrieved by an interrupted run: continue after the last one
+        for items, nextCursor in pageJournal.read_pages():
+            messageCount += len(items)
+            if len(items) > 0:
+                yield items
+            moreMessages = nextCursor is not None
+            cursor = nextCursor
+    if not moreMessages:
+        return
+    ageCutoff = age_cutoff()   # once per space
+
+    # returns the page up to the limits and if more pages are needed. Called by fetch_message_pages
+    # for every page as it arrives, so it only requests the next page if it is needed.
+    def trim_page(items, moreMessages):
+        nonlocal messageCount
+        if checkpoint is not None:
+            checkpointIndex = find_checkpoint(items, checkpoint)
+            if checkpointIndex is not None:   # reached the previous backup: no more pages needed
+                items = items[0:checkpointIndex]
+                moreMessages = False
+        if messageCount + len(items) >= maxMessageCount:
+            items = items[0:maxMessageCount - messageCount]
+            if moreMessages:   # There ARE more messages but the maxTotalMessages has been reached
+                log("          Reached configured maximum # messages (" + str(maxMessageCount) + ")")
+            moreMessages = False
+        # _check_ if the last message retrieved is _OLDER_ than the configured max msg age.
+        #      If yes: trim the page to the max age (the first message at or before the cutoff,
+        #      pages are newest first), older pages are not needed.
+        if ageCutoff and len(items) > 0 and items[-1]['created'] <= ageCutoff:
+            log("          max messages reached (>" + str(msgMaxAge) + " days old)")
+            items = items[0:first_message_before(items, ageCutoff)]
+            moreMessages = False
+        messageCount += len(items)
+        return items, moreMessages
+
+    shards = historyShards if checkpoint is None and historyStart else 1
+    lowerBound = max(historyStart, ageCutoff) if historyStart else ""
+    for items, nextCursor in fetch_message_pages(api, myroom, myMaxMessages, cursor, trim_page, shards, lowerBound, maxMessageCount - messageCount):
+        if pageJournal is not None:
+            pageJournal.add(items, nextCursor)
+        if len(items) > 0:
+            yield items
+    if checkpoint is not None:
+        log("          New messages since last backup: " + str(messageCount))
+    else:
+        log("          Total messages: " + str(messageCount))
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that retrieves the pages of a space as the API returns them, newest first: a generator
+#          of (messages, cursor of the next page or None after the last page), starting at the
+#          cursor (a message ID) or at the newest message.
+#          trim_page(messages, more pages) returns the page up to the limits and if more pages are
+#          needed, the next page is requested before the page is yielded.
+#          With shards > 1 the history after the first page is split into date ranges that are
+#          retrieved at the same time (see plan_history_shards), and the pages are yielded in the
+#          same order as one after the other. lowerBound: the oldest date that can have messages,
+#          messageLimit: the max. number of messages that are needed (maxTotalMessages).
+def fetch_message_pages(api, myroom, myMaxMessages, cursor, trim_page, shards=1, lowerBound="", messageLimit=999999):
+    payload = {'roomId': myroom, 'max': myMaxMessages}
+    if cursor is not None:
+        payload['beforeMessage'] = cursor
+    page = request_page(api, 'messages', payload)
+    firstPage = True
+    try:
+        while page is not None:
+            try:
+                result, items = page.result()
+            except requests.exceptions.RequestException as e: # A serious problem, like an SSLError or InvalidURL
+                log("          **ERROR** getting messages: " + str(e))
+                raise   # the space fails (and continues in the next run), its history is never cut short
+            page = None
+            if len(items) == 0 and cursor is None:
+                raise EmptySpace(myroom)
+            cursor = next_message_cursor(result)
+            items, moreMessages = trim_page(items, cursor is not None)
+            if not moreMessages:
+                yield items, None
+                return
+            if firstPage and shards > 1:
+                shardList = plan_history_shards(items, cursor, shards, myMaxMessages, lowerBound, messageLimit - len(items))
+                if len(shardList) > 1:
+                    shardPages = fetch_history_shards(api, myroom, myMaxMessages, items, shardList)
+                    yield next(shardPages)   # the first page, the date ranges are on their way
+                    for items, nextCursor in shardPages:
+                        items, moreMessages = trim_page(items, nextCursor is not None)
+                        yield items, nextCursor if moreMessages else None
+                        if not moreMessages:
+                            return
+                    return
+            page = request_page(api, 'messages', {'roomId': myroom, 'max': myMaxMessages, 'beforeMessage': cursor})
+            firstPage = False
+            yield items, cursor
+    finally:
+        if page is not None:   # the caller stopped early
+            page.cancel()
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that returns the cursor (beforeMessage) of the next page in the Link header of a
+#          /messages response, or None for the last page
+def next_message_cursor(result):
+    if "Link" not in result.headers:
+        return None
+    return result.headers['Link'].split("beforeMessage=")[1].split(">")[0].split("&")[0]
+
+
+# ----------------------------------------------------------------------------------------
+# CLASS one date range of the history of a space, retrieved by fetch_history_shard(): the messages
+#       from 'after' (included, '' = from the start) to the cursor (a message ID) or to 'before'
+#       (a date, excluded). The pages are stored in a temporary file as they arrive, the file
+#       offset of each page is put in the 'pages' queue, followed by None when the range is done.
+historyShardMinPages = 4   # min. estimated number of pages per date range
+
+class HistoryShard:
+    def __init__(self, after, before="", cursor=None):
+        self.after = after
+        self.before = before
+        self.cursor = cursor
+        self.file = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.pages = queue.Queue()
+        self.error = None
+        self.cancelled = False
+
+    def add_page(self, messages):
+        with self.lock:
+            self.file.seek(0, os.SEEK_END)
+            offset = self.file.tell()
+            self.file.write(json.dumps(messages) + "\n")
+        self.pages.put(offset)
+
+    def read_page(self, offset):
+        with self.lock:
+            self.file.seek(offset)
+            return json.loads(self.file.readline())
+
+    def close(self):
+        self.file.close()
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that splits the history of a space after the first page into date ranges. The number
+#          of pages is estimated from the time span of the first page, each range should have
+#          historyShardMinPages pages or more. Only the pages of the messageLimit messages that are
+#          still needed count: with a count limit the ranges end at the estimated date of the last one.
+#          Returns the HistoryShards, newest first: the first one continues at the cursor of the first
+#          page, the last one has no lower limit (so messages older than lowerBound are never missed).
+#          Returns [] if the space (or the rest of the messages in scope) is too small.
+def plan_history_shards(firstPage, cursor, shards, myMaxMessages, lowerBound, messageLimit):
+    if not lowerBound:
+        return []
+    newest = parse_webex_date(firstPage[0]['created'])
+    oldest = parse_webex_date(firstPage[-1]['created'])
+    start = parse_webex_date(lowerBound)
+    if start >= oldest:
+        return []
+    pageSeconds = max((newest - oldest).total_seconds(), 1) * myMaxMessages / len(firstPage)
+    estimatedPages = (oldest - start).total_seconds() / pageSeconds
+    if estimatedPages > messageLimit / myMaxMessages:   # the count limit comes first
+        estimatedPages = messageLimit / myMaxMessages
+        start = oldest - datetime.timedelta(seconds=estimatedPages * pageSeconds)
+    shardCount = min(shards, int(estimatedPages / historyShardMinPages))
+    if shardCount < 2:
+        return []
+    step = (oldest - start) / shardCount
+    boundaries = [webex_date(oldest - step * shardNr) for shardNr in range(1, shardCount)]
+    shardList = [HistoryShard(boundaries[0], cursor=cursor)]
+    for shardNr in range(1, shardCount):
+        shardList.append(HistoryShard(boundaries[shardNr] if shardNr < shardCount - 1 else "", before=boundaries[shardNr - 1]))
+    return shardList
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that retrieves the pages of one date range (in a worker thread of fetch_history_shards)
+#          for 'space' (the SpaceState, for the log and metrics).
+#          Messages outside of the range are left out: every message is in exactly one range.
+def fetch_history_shard(api, myroom, myMaxMessages, shard, space):
+    spaceContext.space = space
+    try:
+        payload = {'roomId': myroom, 'max': myMaxMessages}
+        if shard.cursor is not None:
+            payload['beforeMessage'] = shard.cursor
+        else:
+            payload['before'] = shard.before
+        while not shard.cancelled:
+            result = api.get('messages', params=payload)
+            items = result.json()["items"]
+            nextCursor = next_message_cursor(result)
+            if len(items) > 0 and items[-1]['created'] < shard.after:   # reached the next range
+                items = [msg for msg in items if msg['created'] >= shard.after]
+                nextCursor = None
+            if shard.before:
+                items = [msg for msg in items if msg['created'] < shard.before]
+            shard.add_page(items)
+            if nextCursor is None:
                 break
-        except requests.exceptions.RequestException as e: # A serious problem, like an SSLError or InvalidURL
-            print("          EXCEPT status_code: " + str(e.status_code))
-            print("          EXCEPT text: " + str(e.text))
-            print("          EXCEPT headers", e.headers)
-            if e.status_code == 429:
-                print("          Code 429, waiting for : " + str(sleepTime) + " seconds: ", end='', flush=True)
-                for x in range(0, sleepTime):
-                    time.sleep(1)
-                    print(".", end='', flush=True) # Progress indicator
+            payload = {'roomId': myroom, 'max': myMaxMessages, 'beforeMessage': nextCursor}
+    except Exception as e:
+        shard.error = e
+    finally:
+        spaceContext.space = None
+    shard.pages.put(None)
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that retrieves the date ranges of a space at the same time and yields their pages in
+#          order, as (messages, cursor of the next page) like fetch_message_pages(), starting with
+#          firstPage (the page before the first range) as soon as all ranges are requested.
+#          The cursor of a page is its last message: pages can be journaled and continued like
+#          normal pages. A range that fails stops the backup of the space, so no messages are missed.
+def fetch_history_shards(api, myroom, myMaxMessages, firstPage, shardList):
+    metrics.count("history shards", len(shardList))
+    space = getattr(spaceContext, 'space', None)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(shardList)) as executor:
+            for shard in shardList:
+                executor.submit(fetch_history_shard, api, myroom, myMaxMessages, shard, space)
+            try:
+                yield firstPage, shardList[0].cursor
+                for shard in shardList:
+                    while True:
+                        offset = shard.pages.get()
+                        if offset is None:
+                            break
+                        items = shard.read_page(offset)
+                        if len(items) > 0:
+                            yield items, items[-1]['id']
+                    if shard.error is not None:
+                        raise shard.error
+            finally:   # also when the caller stops early (max. messages reached): stop all ranges
+                for shard in shardList:
+                    shard.cancelled = True
+        yield [], None
+    finally:
+        for shard in shardList:
+            shard.close()
+
+
+# ----------------------------------------------------------------------------------------
+# CLASS that holds the messages of one space while it is backed up. Pages of top-level messages
+#       are written to a temporary file as they arrive, so memory use depends on the page size
+#       and not on the size of the space. Thread replies are kept in memory for the whole backup
+#       of the space: they are rendered after their parent and are needed again for the .json
+#       output and the incremental backup state. Also collects the unique authors of the messages.
+#       Pages must be added newest messages first, like the API returns them.
+class MessageSpool:
+    def __init__(self):
+        self.file = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+        self.pageOffsets = list()
+        self.threadReplies = dict()   # parentId -> replies (newest first)
+        self.messageCount = 0
+        self.newestMessage = None
+        self.uniqueUserIds = list()
+        self.uniqueUserMails = list()
+        self.userIdSet = set()
+
+    def add_page(self, messages):
+        topLevel = list()
+        for msg in messages:
+            if 'parentId' in msg:   # THREADED MESSAGE!
+                self.threadReplies.setdefault(msg['parentId'], list()).append(msg)
             else:
-                print("          EXCEPT ELSE e:" + e + " e.code:" + e.code)
-                break
-    if maxTotalMessages == 0:
-        print(" **ERROR** there are no messages. Please check your maxMessages setting and try again.")
-        leave()
-    return resultjsonmessages[0:maxTotalMessages]
+                topLevel.append(msg)
+            if msg['personId'] not in self.userIdSet:
+                self.userIdSet.add(msg['personId'])
+                self.uniqueUserIds.append(msg['personId'])
+                self.uniqueUserMails.append(msg['personEmail'])
+        if self.newestMessage is None and len(messages) > 0:
+            self.newestMessage = messages[0]
+        self.messageCount += len(messages)
+        if len(topLevel) > 0:
+            self.file.seek(0, os.SEEK_END)
+            self.pageOffsets.append(self.file.tell())
+            self.file.write("[" + ", ".join(message_json(msg) for msg in topLevel) + "]\n")
+
+    def read_page(self, pageNumber):
+        self.file.seek(self.pageOffsets[pageNumber])
+        return json.loads(self.file.readline())
+
+    # top-level messages, one page in memory at a time
+    def iter_toplevel(self, oldToNew):
+        if oldToNew:
+            for pageNumber in reversed(range(len(self.pageOffsets))):
+                yield from reversed(self.read_page(pageNumber))
+        else:
+            for pageNumber in range(len(self.pageOffsets)):
+                yield from self.read_page(pageNumber)
+
+    # (message, is threaded reply) in display order: top-level messages follow the sort setting,
+    # replies always follow their parent old to new. Replies to a parent outside of the current
+    # message scope are left out.
+    def iter_render_order(self, oldToNew):
+        for msg in self.iter_toplevel(oldToNew):
+            yield msg, False
+            for reply in reversed(self.threadReplies.get(msg['id'], [])):
+                yield reply, True
+
+    # all messages, newest first (for the .json output and the incremental backup state)
+    def iter_newest_first(self):
+        replies = sorted((reply for replies in self.threadReplies.values() for reply in replies), key=lambda msg: msg['created'], reverse=True)
+        return heapq.merge(self.iter_toplevel(False), replies, key=lambda msg: msg['created'], reverse=True)
+
+    def close(self):
+        self.file.close()
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that returns the index of the first message (newest first) that was already part
+#          of the previous backup, or None if the checkpoint is not on this page.
+def find_checkpoint(messages, checkpoint):
+    for index, msg in enumerate(messages):
+        if msg['id'] == checkpoint['lastMessageId'] or msg['created'] < checkpoint['lastMessageCreated']:
+            return index
+    return None
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTIONs that load and save the incremental backup state of a space: the checkpoint
+#          (last message, backup folder, downloaded files) and all messages of the backup.
+#          Both are stored in the stateFolder, named after the space ID.
+def state_filename(roomId, extension):
+    return os.path.join(stateFolder, "".join(re.findall(r'[A-Za-z0-9]+', roomId)) + extension)
+
+def load_checkpoint(roomId):
+    try:
+        with open(state_filename(roomId, ".checkpoint.json"), 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not os.path.isdir(checkpoint['folder']) or not os.path.isfile(state_filename(roomId, ".messages.jsonl")):
+        return None   # backup folder was removed: make a new full backup
+    return checkpoint
+
+def write_json_file(data, filename):
+    with open(filename + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(filename + ".tmp", filename)
+
+def save_checkpoint(space, outputFileName, spool):
+    os.makedirs(stateFolder, exist_ok=True)
+    messagesFile = state_filename(space.roomId, ".messages.jsonl")   # one message per line, newest first
+    with open(messagesFile + ".tmp", 'w', encoding='utf-8') as f:
+        for msg in spool.iter_newest_first():
+            f.write(message_json(msg) + "\n")
+    os.replace(messagesFile + ".tmp", messagesFile)
+    checkpoint = {'roomId': space.roomId, 'folder': space.attachmentFolder, 'outputFileName': outputFileName,
+                  'lastMessageId': spool.newestMessage['id'], 'lastMessageCreated': spool.newestMessage['created'],
+                  'backupTime': datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"), 'files': space.knownFiles}
+    write_json_file(checkpoint, state_filename(space.roomId, ".checkpoint.json"))
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that reads the messages of the previous backup (newest first) in pages, leaving out
+#          the messages in skipIds (retrieved again in this run)
+def get_stored_message_pages(roomId, pageSize, skipIds):
+    page = list()
+    with open(state_filename(roomId, ".messages.jsonl"), 'r', encoding='utf-8') as f:
+        for line in f:
+            msg = json.loads(line)
+            if msg['id'] in skipIds:
+                continue
+            page.append(msg)
+            if len(page) == pageSize:
+                yield page
+                page = list()
+    if len(page) > 0:
+        yield page
+
+
+# ----------------------------------------------------------------------------------------
+# CLASS job journal of a run (journal.json in the stateFolder): the state of every space that
+#       was started ('running', 'done' or 'failed'), its backup folder and the settings of the run.
+#       When a run stops before all spaces are backed up (crash, expired token, Ctrl-C...), the
+#       next run with the same settings continues it: spaces that are done are skipped (unless
+#       they have new activity since) and spaces that were running or failed continue in the same
+#       folder, after the message pages that were already retrieved (see PageJournal). Attachments and avatars that were downloaded are in the
+#       attachment store and person cache, partly downloaded attachments are resumed.
+#       The journal is removed when all spaces are backed up.
+class JobJournal:
+    def __init__(self, filename, settings):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.journal = {'settings': settings, 'started': runStartTime, 'spaces': dict()}
+        self.resumed = False
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                journal = json.load(f)
+            if journal['settings'] == settings:
+                self.journal = journal
+                self.resumed = True
+        except (OSError, ValueError, KeyError):
+            pass
+        self.started = self.journal['started']   # start of the (first attempt of the) run
+
+    def space(self, roomId):
+        with self.lock:
+            return dict(self.journal['spaces'].get(roomId, {}))
+
+    def update(self, roomId, **values):
+        with self.lock:
+            self.journal['spaces'].setdefault(roomId, dict()).update(values)
+            os.makedirs(stateFolder, exist_ok=True)
+            write_json_file(self.journal, self.filename)
+
+    def finish(self):
+        with self.lock:
+            if os.path.isfile(self.filename):
+                os.remove(self.filename)
+
+
+# ----------------------------------------------------------------------------------------
+# CLASS journal of the message pages retrieved for a space (<roomId>.pages.jsonl in the
+#       stateFolder), one line per page: {"items": [...], "next": cursor of the next page or null}.
+#       The backup of an interrupted space continues after the last page in the journal.
+class PageJournal:
+    def __init__(self, roomId, resume):
+        self.filename = state_filename(roomId, ".pages.jsonl")
+        self.file = None
+        if not resume and os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+    # (items, next cursor) of every page in the journal. A page that was only partly written
+    # when the run stopped is removed.
+    def read_pages(self):
+        if not os.path.isfile(self.filename):
+            return
+        validSize = 0
+        with open(self.filename, 'r', encoding='utf-8') as f:
+            while True:
+                line = f.readline()
+                if not line.endswith("\n"):
+                    break
+                try:
+                    page = json.loads(line)
+                except ValueError:
+                    break
+                validSize = f.tell()
+                yield page['items'], page['next']
+        os.truncate(self.filename, validSize)
+
+    def add(self, items, nextCursor):
+        if self.file is None:
+            os.makedirs(stateFolder, exist_ok=True)
+            self.file = open(self.filename, 'a', encoding='utf-8')
+        self.file.write('{"items": [' + ", ".join(message_json(msg) for msg in items) + '], "next": ' + json.dumps(nextCursor) + '}\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTIONs for the space manifest (incremental backups): for every space the id, title, type,
+#          lastActivity and the time of its last backup. 'complete' has, per space type, the start
+#          time of the last run that backed up all spaces of that type.
+def load_manifest():
+    try:
+        with open(os.path.join(stateFolder, "manifest.json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'rooms': dict(), 'complete': dict()}
+
+def save_manifest(manifest):
+    os.makedirs(stateFolder, exist_ok=True)
+    write_json_file(manifest, os.path.join(stateFolder, "manifest.json"))
+
+# Spaces without activity since this date were all backed up already (None: no complete backup yet)
+def manifest_cutoff(manifest):
+    if 'direct' not in manifest['complete'] or 'group' not in manifest['complete']:
+        return None
+    return min(manifest['complete']['direct'], manifest['complete']['group'])
+
+# True if the space had no activity since its last backup (and that backup still exists)
+def space_unchanged(manifest, roomId, room):
+    previous = manifest['rooms'].get(roomId)
+    if previous is None or room['lastActivity'] == "" or room['lastActivity'] > previous['lastBackup']:
+        return False
+    return os.path.isfile(state_filename(roomId, ".checkpoint.json"))
+
 
 # ----------------------------------------------------------------------------------------
 # FUNCTION to turn Teams Space name into a valid filename string
@@ -353,47 +1448,43 @@ def format_filename(s):
 
 # ----------------------------------------------------------------------------------------
 # FUNCTION get the Space-name (Used in the header + optionally for the filename)
-def get_roomname(mytoken, myroom):
-    headers = {'Authorization': 'Bearer ' + mytoken, 'content-type': 'application/json; charset=utf-8'}
+def get_roomname(api, myroom):
     returndata = "webexteams-space-archive"
     try:
-        result = requests.get('https://api.ciscospark.com/v1/rooms/' + myroom, headers=headers)
+        result = api.get('rooms/' + myroom)
         if result.status_code == 401:   # WRONG ACCESS TOKEN
-            print(""""\n\n\n
+            log(""""\n\n\n
                     -------------------------- ERROR ------------------------
                 Please check your Personal Access Token.
                 Note that your Access Token is only valid for 12 hours.
                 Go here to get a new token:
                 https://developer.webex.com/docs/api/getting-started
                     ------------------------- STOPPED ----------------------- \n\n\n""")
-            leave()
+            raise SpaceFailed("401 - invalid access token")
         elif result.status_code == 404: #and "resource could not be found" in str(result.text) --> WRONG SPACE ID
-            print("       **ERROR** 404 - Please check if the Space ID in your .ini file is correct.")
-            print("    ------------------------- STOPPED ----------------------- \n\n\n")
-            leave()
+            log("       **ERROR** 404 - Please check if the Space ID in your .ini file is correct.")
+            log("    ------------------------- STOPPED ----------------------- \n\n\n")
+            raise SpaceFailed("404 - space not found")
         elif result.status_code != 200:
-            print("       **ERROR** <>200 Unknown Error occurred. status code: " + str(result.status_code) + "\n       Info: \n " + result.text)
-            leave()
+            log("       **ERROR** <>200 Unknown Error occurred. status code: " + str(result.status_code) + "\n       Info: \n " + result.text)
+            raise SpaceFailed("status code " + str(result.status_code))
         elif result.status_code == 200:
             returndata = result.json()['title']
+    except SpaceFailed:
+        raise
     except Exception as e:
-        print(" ********* EXCEPTION *********" + str(e))
-        if result.status_code == 429:
-            print("       **ERROR** #1 get_roomname API call 429 - too many requests!! : " + str(result.status_code))
-        else:
-            print("       **ERROR** #1 get_roomname API call status_code: " + str(result.status_code))
-            print("       **ERROR** #1 get_roomname API call status text: " + str(result.text))
+        log(" ********* EXCEPTION *********" + str(e))
+        log("       **ERROR** #1 get_roomname API call failed")
         beep(3)
-        leave()
+        raise SpaceFailed("get_roomname API call failed: " + str(e))
     return str(returndata.strip())
 
 
 # ----------------------------------------------------------------------------------------
 # FUNCTION get your own details. Name: displayed in the header.
 #          Also used to get your email domain: mark _other_ domains as 'external' messages
-def get_me(mytoken):
-    header = {'Authorization': "Bearer " + mytoken,'content-type': 'application/json; charset=utf-8'}
-    result = requests.get(url='https://api.ciscospark.com/v1/people/me', headers=header)
+def get_me(api):
+    result = api.get('people/me')
     return result.json()
 
 
@@ -410,229 +1501,604 @@ def convert_size(size_bytes):
 
 
 # ----------------------------------------------------------------------------------------
-# FUNCTION to download message images & files (if enabled)
-def process_Files(fileData):
-    global myErrorList
+# CLASS that caps the total download speed of all workers together (token bucket).
+#       A rate of 0 means unlimited.
+class BandwidthLimiter:
+    def __init__(self, bytesPerSecond):
+        self.rate = bytesPerSecond
+        self.allowance = bytesPerSecond
+        self.lastCheck = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.lastCheck) * self.rate)
+            self.lastCheck = now
+            self.allowance -= nbytes
+            waitTime = -self.allowance / self.rate if self.allowance < 0 else 0
+        if waitTime > 0:
+            time.sleep(waitTime)
+
+
+# ----------------------------------------------------------------------------------------
+# CLASS bounded worker pool for attachment requests. Caps the number of workers, the number
+#       of simultaneous requests per host and the total bandwidth. Shared by all spaces.
+class DownloadPool:
+    def __init__(self, workers, maxPerHost, maxBandwidth):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.maxPerHost = maxPerHost
+        self.hostLimits = dict()
+        self.hostLock = threading.Lock()
+        self.bandwidth = BandwidthLimiter(maxBandwidth)
+
+    def host_limit(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.hostLock:
+            if host not in self.hostLimits:
+                self.hostLimits[host] = threading.BoundedSemaphore(self.maxPerHost)
+            return self.hostLimits[host]
+
+    def submit(self, function, url, *args):
+        def run():
+            with self.host_limit(url):
+                return function(url, *args)
+        return self.executor.submit(run)
+
+    # writes the body of response r to file f (and adds it to digest, a hashlib object)
+    def write_response(self, r, f, digest=None):
+        for chunk in r.iter_content(chunk_size=65536):
+            self.bandwidth.consume(len(chunk))
+            metrics.count("bytes downloaded", len(chunk))
+            if digest is not None:
+                digest.update(chunk)
+            f.write(chunk)
+
+
+# ----------------------------------------------------------------------------------------
+# CLASS content-addressed store of the downloaded attachments, shared by all spaces and runs.
+#       Files are stored once, named after the SHA-256 of their content, and linked into the
+#       backup folders. The index has the filename, size and content hash of every attachment
+#       by its Webex content id: attachments in the index are not requested again. Changes are
+#       appended to index.log as they happen (so they survive an interrupted run) and merged
+#       into index.json by save(). Partly downloaded files (<content id>.tmp) are resumed.
+#       With enabled=False the files are stored in the 'downloads' folder, which is removed
+#       when a run is complete; only the filenames and sizes are kept.
+class AttachmentStore:
+    def __init__(self, folder, enabled):
+        self.folder = folder
+        self.enabled = enabled
+        self.fileFolder = folder if enabled else os.path.join(os.path.dirname(folder), "downloads")
+        self.lock = threading.Lock()
+        self.contentLocks = dict()   # content id -> lock: each attachment is requested once
+        self.index = dict()          # content id -> {'name': ..., 'size': ..., 'hash': ...}
+        self.logFile = None
+        self.requestCount = 0
+        self.downloadCount = 0
+        self.resumeCount = 0
+        self.reuseCount = 0
+        try:
+            with open(os.path.join(folder, "index.json"), 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            pass
+        try:
+            with open(os.path.join(folder, "index.log"), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        continue   # partly written line of an interrupted run
+                    self.index.setdefault(change.pop('id'), dict()).update(change)
+        except OSError:
+            pass
+
+    @staticmethod
+    def content_id(url):
+        return urllib.parse.urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1]
+
+    def content_lock(self, url):
+        with self.lock:
+            return self.contentLocks.setdefault(self.content_id(url), threading.Lock())
+
+    # file of an attachment while it is downloaded
+    def partial_file(self, url):
+        return os.path.join(self.fileFolder, "".join(re.findall(r'[A-Za-z0-9]+', self.content_id(url))) + ".tmp")
+
+    def update_index(self, contentId, **values):   # call with self.lock
+        self.index.setdefault(contentId, dict()).update(values)
+        if self.logFile is None:
+            os.makedirs(self.folder, exist_ok=True)
+            self.logFile = open(os.path.join(self.folder, "index.log"), 'a', encoding='utf-8')
+        self.logFile.write(json.dumps(dict(values, id=contentId)) + "\n")
+        self.logFile.flush()
+
+    # (filename, filesize, stored file or None) of an attachment, or None if it is not in the index
+    def get_info(self, url):
+        with self.lock:
+            entry = self.index.get(self.content_id(url))
+            if entry is None or 'name' not in entry:
+                return None
+            storedFile = None
+            if 'hash' in entry:
+                storedFile = os.path.join(self.fileFolder, entry['hash'])
+        if storedFile is not None and not os.path.isfile(storedFile):
+            storedFile = None
+        return entry['name'], entry['size'], storedFile
+
+    def set_info(self, url, filename, filesize):
+        with self.lock:
+            self.requestCount += 1
+            self.update_index(self.content_id(url), name=filename, size=filesize)
+
+    # stores the body of response r, returns the stored file. A '206 Partial Content' response
+    # (see fetch_attachment) continues the partial file.
+    def store(self, url, r):
+        os.makedirs(self.fileFolder, exist_ok=True)
+        partialFile = self.partial_file(url)
+        digest = hashlib.sha256()
+        if r.status_code == 206:
+            with open(partialFile, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b""):
+                    digest.update(chunk)
+            with self.lock:
+                self.resumeCount += 1
+            mode = 'ab'
+        else:
+            mode = 'wb'
+        with open(partialFile, mode) as f:   # on errors the partial file is kept, to resume it
+            downloadPool.write_response(r, f, digest)
+        contentHash = digest.hexdigest()
+        storedFile = os.path.join(self.fileFolder, contentHash)
+        if os.path.isfile(storedFile):   # same content as an attachment with another id
+            os.remove(partialFile)
+        else:
+            os.replace(partialFile, storedFile)
+        with self.lock:
+            self.update_index(self.content_id(url), hash=contentHash)
+            self.downloadCount += 1
+        return storedFile
+
+    def reused(self):
+        with self.lock:
+            self.reuseCount += 1
+
+    # merges index.log into index.json
+    def save(self):
+        with self.lock:
+            if self.logFile is None:
+                return
+            write_json_file(self.index, os.path.join(self.folder, "index.json"))
+            self.logFile.close()
+            self.logFile = None
+            os.remove(os.path.join(self.folder, "index.log"))
+
+    # without the attachment store: remove the downloaded files (when the run is complete)
+    def remove_downloads(self):
+        if not self.enabled:
+            shutil.rmtree(self.fileFolder, ignore_errors=True)
+
+    def report(self):
+        return f"Attachment requests: {self.requestCount} - downloaded: {self.downloadCount} (resumed: {self.resumeCount}) - taken from the attachment store: {self.reuseCount}"
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that gets the filename + filesize of a file attachment from the headers of a
+#          HEAD or GET response.
+def fileinfo_from_headers(headers, url, space):
+    try:
+        filename = str(headers['Content-Disposition']).split("\"")[1]
+        # Files with no name or just spaces: fix so they can still be downloaded:
+        if len(filename) < 1 or filename.isspace():
+            filename = "unknown-filename"
+        if filename == ('+' * (int(len(filename)/len('+'))+1))[:len(filename)]:
+            filename = "unknown-filename"
+            beep(1)
+    except Exception as e:
+        filename = "error-getting-filename"
+        space.errorList.append("def process_Files Header 'content-disposition' error for url: " + url)
+    filename = format_filename(filename)
+    try:
+        if 'Content-Range' in headers:   # resumed download: "bytes 1000-1999/2000"
+            filesize = convert_size(int(headers['Content-Range'].rsplit("/", 1)[1]))
+        else:
+            filesize = convert_size(int(headers['Content-Length']))
+    except:
+        filesize = 'could not determine filesize'
+    return filename, filesize
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that returns True if an attachment with this filename is downloaded (downloadFiles)
+def is_image(filename):
+    return os.path.splitext(filename)[1][1:].replace("\"","").lower() in ['png', 'jpg','bmp', 'gif', 'tif', 'jpeg']
+
+def download_wanted(filename):
+    return downloadFiles == 'files' or (downloadFiles == 'images' and is_image(filename))
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that starts the download of an attachment. A partial file of an interrupted download
+#          is resumed with a Range request (the server answers '206 Partial Content').
+def open_attachment(url):
+    partialFile = attachmentStore.partial_file(url)
+    if os.path.isfile(partialFile) and os.path.getsize(partialFile) > 0:
+        r = webexAPI.get(url, headers={"Accept-Encoding": "", "Range": f"bytes={os.path.getsize(partialFile)}-"}, stream=True)
+        if r.status_code != 416:   # 416: the partial file can't be resumed
+            return r
+        r.close()
+        os.remove(partialFile)
+    return webexAPI.get(url, headers={"Accept-Encoding": ""}, stream=True)
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that fetches an attachment in the download pool: returns (filename, filesize, stored
+#          file or None), or None if the file was deleted. One request per attachment at most:
+#           - attachments in the attachment store index: no request (unless the file is needed
+#             and not stored)
+#           - downloadFiles = 'files': GET, filename + size come from its headers
+#           - other attachments: HEAD for the filename + size, followed by a GET if the file is
+#             wanted ('images': an image that is not in the index yet). A GET is only sent for
+#             files that are stored: a body that is not read would cost the pooled connection.
+#          Only the filename + size of a successful response are added to the index.
+def fetch_attachment(url, space):
+    with attachmentStore.content_lock(url):
+        info = attachmentStore.get_info(url)
+        if info is not None and (info[2] is not None or not download_wanted(info[0])):
+            attachmentStore.reused()
+            return info
+        if downloadFiles != 'files' and info is None:
+            r = webexAPI.head(url, headers={"Accept-Encoding": ""})
+            if r.status_code == 404:  # Item must have been deleted since url was retrieved
+                return None
+            filename, filesize = fileinfo_from_headers(r.headers, url, space)
+            if not 200 <= r.status_code < 300:   # not in the index: asked again in the next run
+                space.log(f"----- ERROR:  {r.status_code} {r.reason} for url: {url}")
+                space.errorList.append("def process_Files getting file details failed for file: " + filename)
+                return filename, filesize, None
+            attachmentStore.set_info(url, filename, filesize)
+            if not download_wanted(filename):
+                return filename, filesize, None
+        with open_attachment(url) as r:
+            if r.status_code == 404:  # Item must have been deleted since url was retrieved
+                return None
+            filename, filesize = fileinfo_from_headers(r.headers, url, space)
+            try:
+                r.raise_for_status()
+                attachmentStore.set_info(url, filename, filesize)
+                storedFile = attachmentStore.store(url, r)
+            except Exception as e:
+                space.log(f"----- ERROR:  {e}")
+                space.errorList.append("def process_Files download failed for file: " + filename)
+                storedFile = None
+        space.log(".", end='') # Progress indicator
+        return filename, filesize, storedFile
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that fetches all attachments of messages in the download pool.
+#          Adds them to fileInfo, a dictionary: url -> future with the fetch_attachment() result.
+#          Files of an earlier backup are only fetched if they were listed (subfolder "") but
+#          are wanted now (other downloadFiles setting).
+def prefetch_fileinfo(space, messages, fileInfo):
+    for msg in messages:
+        for url in msg.get('files', []):
+            knownFile = space.knownFiles.get(url)
+            if url not in fileInfo and (knownFile is None or (knownFile[0] == "" and download_wanted(knownFile[1]))):
+                fileInfo[url] = downloadPool.submit(fetch_attachment, url, space)
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION to place message images & files in the backup (if enabled)
+#          Filenames are made unique in message order (so always the same result), then the
+#          fetched file is linked into the backup folder.
+#          space.filenameCounters remembers the next "-x" counter to try for each filename,
+#          so many files with the same name don't probe all earlier counters again.
+def process_Files(space, fileData, fileInfo):
     filelist = list()
     for url in fileData:
-        headers = {"Authorization": f"Bearer {myToken}","Accept-Encoding": ""}
-        r = requests.head(url, headers=headers)
-        if r.status_code == 404:  # Item must have been deleted since url was retrieved
+        knownFile = space.knownFiles.get(url)   # file of an earlier (incremental) backup
+        if url in fileInfo:
+            fileDetails = fileInfo[url].result()
+        else:
+            fileDetails = knownFile[1], knownFile[2], None
+        if fileDetails is None:
+            if knownFile is not None:   # listed in an earlier backup, deleted since
+                space.errorList.append("def process_Files file of an earlier backup was deleted: " + knownFile[1])
+                filelist.append(knownFile[1] + "###" + knownFile[2] + "###deleted")
             continue
-        try:
-            filename = str(r.headers['Content-Disposition']).split("\"")[1]
-            # Files with no name or just spaces: fix so they can still be downloaded:
-            if len(filename) < 1 or filename.isspace():
-                filename = "unknown-filename"
-            if filename == ('+' * (int(len(filename)/len('+'))+1))[:len(filename)]:
-                filename = "unknown-filename"
-                beep(1)
-        except Exception as e:
-            filename = "error-getting-filename"
-            myErrorList.append("def process_Files Header 'content-disposition' error for url: " + url)
-        filename = format_filename(filename)
-        try:
-            filesize = convert_size(int(r.headers['Content-Length']))
-        except:
-            filesize = 'could not determine filesize'
+        filename, filesize, storedFile = fileDetails
         fileextension = os.path.splitext(filename)[1][1:].replace("\"","")
         filenamepart = os.path.splitext(filename)[0]
-        # if int(r.headers['Content-Length']) <= 0:
-        #     # Not downloading 0 Byte files, only show the filename
-        #     filelist.append(filename + "###" + filesize)
-        #     continue
-        if downloadFiles not in ['images', 'files']:
-            # No file downloading --> just get the filename + size
-            filelist.append(filename + "###" + filesize)
-            continue
-        if "image" in downloadFiles and fileextension.lower() not in ['png', 'jpg','bmp', 'gif', 'tif', 'jpeg']:
-            # File is not an image --> just get the filename + size
+        if not download_wanted(filename):
+            # No file downloading, or file is not an image --> just get the filename + size
+            space.knownFiles.setdefault(url, ["", filename, filesize])
             filelist.append(filename + "###" + filesize)
             continue
-        if fileextension.lower() in ['png', 'jpg','bmp', 'gif', 'tif', 'jpeg']:
+        if is_image(filename):
             # File is an image
             subfolder = "/images/"
         else:
             # File is a non-image file
             subfolder = "/files/"
-        # CHECK if filename exists, if yes, add "-x" where x is a counter
-        if downloadFiles in ['images', 'files']:
-            if os.path.isfile(myAttachmentFolder + subfolder + filename): # File exist? add '-<number>' to the filename.
-                filepartName = filenamepart
-                filepartExtension = "." + fileextension
-                filepartCounter = 1
-                while os.path.isfile(myAttachmentFolder + subfolder + filepartName + "-" + str(filepartCounter) + filepartExtension):
-                    filepartCounter += 1
-                filename = filepartName + "-" + str(filepartCounter) + filepartExtension
-        # DOWNLOAD file
-        try:
-            with requests.get(url, headers=headers, stream=True) as r:
-                with open(myAttachmentFolder + subfolder + filename, 'wb') as f:
-                    shutil.copyfileobj(r.raw, f)
+        if knownFile is not None and knownFile[0] == subfolder:
+            # File of an earlier backup run: keep its filename, only download if it is missing
+            if os.path.isfile(space.attachmentFolder + subfolder + filename):
                 filelist.append(filename + "###" + filesize)
-        except Exception as e:
-            print(f"----- ERROR:  {e}")
-            myErrorList.append("def process_Files download failed for file: " + filename)
-        print(".", end='', flush=True) # Progress indicator
+                continue
+            fetched = downloadPool.submit(fetch_attachment, url, space).result()
+            if fetched is None:   # deleted on the server too: listed without a link
+                space.errorList.append("def process_Files file of an earlier backup was deleted: " + filename)
+                filelist.append(filename + "###" + filesize + "###deleted")
+                continue
+            storedFile = fetched[2]
+        # CHECK if filename was used already, if yes, add "-x" where x is a counter
+        elif subfolder + filename in space.usedFilenames:
+            filepartExtension = "." + fileextension
+            filepartCounter = space.filenameCounters.get(subfolder + filename, 1)
+            while subfolder + filenamepart + "-" + str(filepartCounter) + filepartExtension in space.usedFilenames:
+                filepartCounter += 1
+            space.filenameCounters[subfolder + filename] = filepartCounter + 1
+            filename = filenamepart + "-" + str(filepartCounter) + filepartExtension
+        space.usedFilenames.add(subfolder + filename)
+        space.knownFiles[url] = [subfolder, filename, filesize]
+        if storedFile is not None:
+            link_or_copy(storedFile, space.attachmentFolder + subfolder + filename)
+        filelist.append(filename + "###" + filesize)
     return filelist
 
 
 # ----------------------------------------------------------------------------------------
-# FUNCTION download member avatars (user images). Will retry failed downloads max. 3 times.
-def download_avatars(avatardictionary):
-    global downloadAvatarCount
-    global myErrorList
+# FUNCTION that links a file into a backup folder (hard link: no extra disk space),
+#          or copies it when the file system doesn't support links.
+def link_or_copy(source, target):
+    if os.path.exists(target):
+        if os.path.samefile(source, target):
+            return
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION returns the file name of the avatar of a person in the 'avatars' folder of a backup
+def avatar_filename(personId):
+    return "".join(re.findall(r'[A-Za-z0-9]+', personId))
+
+
+# ----------------------------------------------------------------------------------------
+# CLASS cache of person details (avatar URL) shared by all spaces and kept between runs
+#       for maxAgeDays. Downloaded avatars are stored once, named after the SHA-256 of their
+#       content, and linked into the 'avatars' folder of each backup.
+#       Avatar downloads stop after 'timeout' seconds without data, so a stalled download never
+#       hangs a worker (download_avatars() retries it).
+#       people.json: personId -> {'avatar': URL or None, 'time': lookup time, 'file': hash}
+class PersonCache:
+    def __init__(self, folder, maxAgeDays, timeout=120):
+        self.folder = folder
+        self.avatarFolder = os.path.join(folder, "avatars")
+        self.maxAge = maxAgeDays * 86400
+        self.timeout = timeout
+        self.startTime = time.time()   # people looked up in this run are always used
+        self.lock = threading.Lock()
+        self.lookupLock = threading.Lock()   # one lookup of missing people at a time
+        self.avatarLocks = dict()            # avatar URL -> lock: each avatar is downloaded once
+        self.people = dict()
+        self.lookupCount = 0
+        self.downloadCount = 0
+        if self.maxAge > 0:
+            try:
+                with open(os.path.join(folder, "people.json"), 'r', encoding='utf-8') as f:
+                    self.people = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def is_fresh(self, personId):
+        person = self.people.get(personId)
+        return person is not None and (person['time'] >= self.startTime or time.time() - person['time'] < self.maxAge)
+
+    # personId -> avatar URL (~80 pixels) of the people in personIds. People that are not in
+    # the cache (or too old) are looked up in chunks of 80. A chunk whose lookup failed is not
+    # cached: those people have no avatar in this space and are looked up again by the next one.
+    def get_avatars(self, api, personIds):
+        with self.lock:
+            missing = [personId for personId in personIds if not self.is_fresh(personId)]
+        if len(missing) > 0:
+            with self.lookupLock:
+                with self.lock:   # another space might have looked them up in the meantime
+                    missing = [personId for personId in missing if not self.is_fresh(personId)]
+                for i in range(0, len(missing), 80):
+                    chunk = missing[i:i + 80]
+                    found = dict()
+                    details = get_persondetails(api, chunk)
+                    if details is None:
+                        continue
+                    for persondetails in details:
+                        if 'id' in persondetails:
+                            found[persondetails['id']] = persondetails.get('avatar')
+                    log(".", end='')  # Progress indicator
+                    with self.lock:
+                        self.lookupCount += len(chunk)
+                        for personId in chunk:
+                            previous = self.people.get(personId, {})
+                            avatar = found.get(personId)
+                            if avatar is not None:
+                                avatar = avatar.replace("~1600", "~80")
+                            person = {'avatar': avatar, 'time': time.time()}
+                            if avatar == previous.get('avatar') and 'file' in previous:
+                                person['file'] = previous['file']   # same avatar: keep the stored image
+                            self.people[personId] = person
+        with self.lock:
+            return {personId: self.people[personId]['avatar'] for personId in personIds
+                    if personId in self.people and self.people[personId]['avatar'] is not None}
+
+    # path of the stored avatar of a person, downloaded if not stored yet
+    def avatar_file(self, personId, url):
+        with self.lock:
+            urlLock = self.avatarLocks.setdefault(url, threading.Lock())
+        with urlLock:
+            with self.lock:
+                person = self.people.get(personId, {})
+                if person.get('avatar') == url and 'file' in person:
+                    filepath = os.path.join(self.avatarFolder, person['file'])
+                    if os.path.isfile(filepath):
+                        return filepath
+            with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                content = response.read()
+            metrics.count("bytes downloaded", len(content))
+            contentHash = hashlib.sha256(content).hexdigest()
+            filepath = os.path.join(self.avatarFolder, contentHash)
+            if not os.path.isfile(filepath):
+                os.makedirs(self.avatarFolder, exist_ok=True)
+                with open(filepath + f".{threading.get_ident()}.tmp", 'wb') as f:
+                    f.write(content)
+                os.replace(filepath + f".{threading.get_ident()}.tmp", filepath)
+            with self.lock:
+                self.downloadCount += 1
+                if self.people.get(personId, {}).get('avatar') == url:
+                    self.people[personId]['file'] = contentHash
+            return filepath
+
+    def save(self):
+        if self.maxAge > 0:
+            os.makedirs(self.folder, exist_ok=True)
+            with self.lock:
+                people = dict(self.people)
+            write_json_file(people, os.path.join(self.folder, "people.json"))
+
+    def report(self):
+        return f"Person lookups: {self.lookupCount} - avatars downloaded: {self.downloadCount}"
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION links the member avatars (user images) from the person cache into the backup,
+#          downloading the ones that are not stored yet. Will retry failed downloads max. 3 times.
+def download_avatars(space, avatardictionary, attempt=1):
     if len(avatardictionary) == 0:
-        print('No people found in avatardictionary. Skipping...')
+        space.log('No people found in avatardictionary. Skipping...')
         return
-    myErrorList = [ elem for elem in myErrorList if "def download_avatars download failed" not in elem]
+    space.errorList[:] = [ elem for elem in space.errorList if "def download_avatars download failed" not in elem]
     retryDictionary = dict()
     for key, value in avatardictionary.items():
-        filename = "".join(re.findall(r'[A-Za-z0-9]+', key))
         try:
-            response = urllib.request.urlretrieve(value, myAttachmentFolder + "/avatars/" + filename)
+            link_or_copy(personCache.avatar_file(key, value), space.attachmentFolder + "/avatars/" + avatar_filename(key))
         except Exception as e:
-            myErrorList.append("def download_avatars download failed (attempt #" + str(downloadAvatarCount) + ") for user: " + key + " with URL: " + value)
+            space.errorList.append("def download_avatars download failed (attempt #" + str(attempt) + ") for user: " + key + " with URL: " + value)
             retryDictionary[key] = value # Create temp dictionary for failed avatar downloads - retry later
             continue
-    if len(retryDictionary) > 0 and downloadAvatarCount < 4: # Try failed avatar downloads max 3 times
-        myErrorList.append("             Avatar download attempt nr. " + str(downloadAvatarCount))
+    if len(retryDictionary) > 0 and attempt < 4: # Try failed avatar downloads max 3 times
+        space.errorList.append("             Avatar download attempt nr. " + str(attempt))
         time.sleep(1)
-        downloadAvatarCount += 1
-        download_avatars(retryDictionary)
+        download_avatars(space, retryDictionary, attempt + 1)
 
 
 # ----------------------------------------------------------------------------------------
 # FUNCTION download member details (that include the member avatar URL)
-#          only called when userAvatar = 'download' or 'link'
-def get_persondetails(mytoken, personlist):
-    headers = {'Authorization': 'Bearer ' + mytoken, 'content-type': 'application/json; charset=utf-8'}
+#          only called when userAvatar = 'download' or 'link', returns None if the lookup failed
+def get_persondetails(api, personlist):
     personlist = str(personlist)[2:-2].replace("', '",",")
     payload = {'id': personlist}
     resultjsonmessages = list()
     while True:
         try:
-            result = requests.get('https://api.ciscospark.com/v1/people', headers=headers, params=payload)
-            if result.status_code != 200 and result.status_code != 429:
-                print("     ** ERROR ** def get_persondetails. result.status_code: " + str(result.status_code))
+            result = api.get('people', params=payload)
+            if result.status_code != 200:
+                log("     ** ERROR ** def get_persondetails. result.status_code: " + str(result.status_code))
+                return None
             resultjsonmessages = resultjsonmessages + result.json()["items"]
             break
-        except requests.exceptions.RequestException as e:
-            print(e)
-            print("\n\n get_persondetails Exception e: " + e + "\n\n")
-            if "e.status_code" == "429":
-                print("          Code 429, waiting for : " + str(sleepTime) + " seconds: ", end='', flush=True)
-                for x in range(0, sleepTime):
-                    time.sleep(1)
-                    print(".", end='', flush=True) # Progress indicator
-            else:
-                break
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            log("\n\n get_persondetails Exception e: " + str(e) + "\n\n")
+            return None
     return resultjsonmessages
 
 
 # ----------------------------------------------------------------------------------------
-# FUNCTION retrieve space IDs. Will search all of your spaces and return two dictionaries, separated into individual chats and group chats.
-def get_searchspaces(mytoken):
-    headers = {'Authorization': 'Bearer ' + mytoken, 'content-type': 'application/json; charset=utf-8'}
-    payload = {'sortBy': 'lastactivity', 'max': 900}
-    chat_ids = dict()
-    group_ids = dict()
-    all_spaces = list()
-    while True:
-        try:
-            result = requests.get('https://api.ciscospark.com/v1/rooms', headers=headers, params=payload)
-            if result.status_code == 401:
-                print("    -------------------------- ERROR ------------------------")
-                print("       Please check your Personal Access Token.")
-                print("       Note that your Access Token is only valid for 12 hours.")
-                print("       Go here to get a new token:")
-                print("       https://developer.webex.com/docs/api/getting-started")
-                print("    ------------------------- STOPPED ----------------------- \n\n\n")
-                leave()
-            if "Link" in result.headers:  # there's MORE members
+# FUNCTION that lists your spaces page by page: a generator that yields the spaces of each page as soon as
+#          it arrives, as (space name, space ID, details: title, type, lastActivity and created), so the backups
+#          can start while the list is still loading (and the next page is on its way, see request_page). Space names are unique: a name that is already used gets
+#          a "_1", "_2"... suffix. Spaces that were listed already (on an earlier page) are left out.
+#          Spaces are sorted by last activity: with a cutoff date it stops at the first space without activity since then.
+#          status: a dict, status['complete'] is set to True only if the list was retrieved to its end (or cutoff).
+def get_searchspaces(api, cutoff=None, status=None):
+    page = request_page(api, 'rooms', {'sortBy': 'lastactivity', 'max': 900})
+    roomIds = set()
+    spaceNames = set()
+    nameCounters = dict()   # space name -> next "_x" counter to try
+    try:
+        while page is not None:
+            try:
+                result, items = page.result()
+                if result.status_code == 401:
+                    print("    -------------------------- ERROR ------------------------")
+                    print("       Please check your Personal Access Token.")
+                    print("       Note that your Access Token is only valid for 12 hours.")
+                    print("       Go here to get a new token:")
+                    print("       https://developer.webex.com/docs/api/getting-started")
+                    print("    ------------------------- STOPPED ----------------------- \n\n\n")
+                    leave()
+            except (requests.exceptions.RequestException, ValueError) as e: # A serious problem, like an SSLError or InvalidURL
+                print("          **ERROR** getting spaces: " + str(e))
+                print("          The list of spaces is not complete: run again to back up the other spaces.")
+                return
+            page = None
+            moreSpaces = "Link" in result.headers
+            if cutoff is not None and len(items) > 0 and items[-1].get('lastActivity', cutoff) < cutoff:
+                # the rest of the spaces has no activity since the cutoff date: stop here
+                items = [item for item in items if item.get('lastActivity', cutoff) >= cutoff]
+                moreSpaces = False
+            if moreSpaces:   # request the next page before the spaces of this page are backed up
                 headerLink = result.headers["Link"]
                 myCursor = headerLink[headerLink.find("cursor=")+len("cursor="):headerLink.rfind(">")]
-                payload = {'sortBy': 'lastactivity', 'max': 900, 'cursor': myCursor}
-                all_spaces += all_spaces + result.json()["items"]
-                continue
-            else:
-                all_spaces += all_spaces + result.json()["items"]
-                print(" Number of spaces retrieved: " + str(len(all_spaces)))
-                break
-        except requests.exceptions.RequestException as e: # A serious problem, like an SSLError or InvalidURL
-            if e.status_code == 429:
-                print("          Code 429, waiting for : " + str(sleepTime) + " seconds: ", end='', flush=True)
-                for x in range(0, sleepTime):
-                    time.sleep(1)
-                    print(".", end='', flush=True) # Progress indicator
-            else:
-                break
-    for found_space in all_spaces:
-        try:
-            space_name = found_space['title']
-            dup_counter = 1
-            if space_name in chat_ids or space_name in group_ids:
-                while f"{space_name}_{dup_counter}" in chat_ids or f"{space_name}_{dup_counter}" in group_ids:
-                    dup_counter += 1
-                space_name = f"{space_name}_{dup_counter}"
-            if found_space['type'] == 'direct':             
-                chat_ids[space_name] = found_space['id']
-            elif found_space['type'] == 'group':
-                group_ids[space_name] = found_space['id']
-        except:
-            continue
-    return chat_ids, group_ids
-
-# ----------------------------------------------------------------------------------------
-# FUNCTION that removes any empty spaces from a dictionary(possible if you only called but did not text)
-def check_empty_space(mytoken, myroom):
-    headers = {'Authorization': 'Bearer ' + mytoken, 'content-type': 'application/json; charset=utf-8'}
-    payload = {'roomId': id, 'max': 10}
-    try:
-        result = requests.get('https://api.ciscospark.com/v1/messages', headers=headers, params=payload)
-        messageCount = len(result.json()["items"])
-    except requests.exceptions.RequestException as e: # A serious problem, like an SSLError or InvalidURL
-        print("          EXCEPT status_code: " + str(e.status_code))
-        print("          EXCEPT text: " + str(e.text))
-        print("          EXCEPT headers", e.headers)
-        if e.status_code == 429:
-            print("          Code 429, waiting for : " + str(sleepTime) + " seconds: ", end='', flush=True)
-            for x in range(0, sleepTime):
-                time.sleep(1)
-                print(".", end='', flush=True) # Progress indicator
-        else:
-            print("          EXCEPT ELSE e:" + e + " e.code:" + e.code)
-    if messageCount == 0:
-        print(f"{name} has no messages, removing from backup.")
-        return True
+                page = request_page(api, 'rooms', {'sortBy': 'lastactivity', 'max': 900, 'cursor': myCursor})
+            for found_space in items:
+                if found_space.get('id') in roomIds or found_space.get('type') not in ['direct', 'group']:
+                    continue
+                roomIds.add(found_space['id'])
+                space_name = found_space.get('title', "")
+                if space_name in spaceNames:
+                    dup_counter = nameCounters.get(space_name, 1)
+                    while f"{space_name}_{dup_counter}" in spaceNames:
+                        dup_counter += 1
+                    nameCounters[space_name] = dup_counter + 1
+                    space_name = f"{space_name}_{dup_counter}"
+                spaceNames.add(space_name)
+                yield space_name, found_space['id'], {'title': found_space.get('title', ""), 'type': found_space['type'], 'lastActivity': found_space.get('lastActivity', ""), 'created': found_space.get('created', "")}
+        if status is not None:
+            status['complete'] = True
+    finally:
+        if page is not None:   # the caller stopped early
+            page.cancel()
+    if cutoff is not None:
+        print(" Number of spaces with activity since the last complete backup: " + str(len(roomIds)))
     else:
-        return False
-
+        print(" Number of spaces retrieved: " + str(len(roomIds)))
 
 # ----------------------------------------------------------------------------------------
-# FUNCTION that creates a table with the message order (needed for threaded messages)
-def create_threading_order_table(WebexTeamsMessages):
-    msgOrderTable = dict()
-    msgOrderIndex = 1.000
-    for msg in WebexTeamsMessages:
-        if 'parentId' not in msg:  # NOT a threaded message
-            msgOrderTable[("%.3f" % msgOrderIndex)] = msg['id']
-            msgOrderIndex = msgOrderIndex + 1.000
-        else:   # THREADED MESSAGE!
-            # 1 get msgOrderIndex for parent ID in msgOrderTable.
-            try:
-                newOrderIndex = float(list(msgOrderTable.keys())[list(msgOrderTable.values()).index(msg['parentId'])])
-            except:
-                continue  # message belongs to thread outside of the current message scope
-            # 2 check if nr from parentid + 0.001 exists
-            while True:
-                if ("%.3f" % newOrderIndex) in msgOrderTable:
-                    newOrderIndex = float("%.3f" % (newOrderIndex + 0.001))
-                    continue
-                else:
-                    msgOrderTable[str(newOrderIndex)] = msg['id']
-                    break
-    return msgOrderTable
+# CLASS per-space state. Every space that is backed up gets its own, so spaces that are backed
+#       up at the same time don't share member lists, error lists, folders or downloads.
+class SpaceState:
+    def __init__(self, name, roomId, lastActivity="", created=""):
+        self.name = name
+        self.roomId = roomId
+        self.lastActivity = lastActivity
+        self.created = created
+        self.memberList = dict()      # email -> displayName
+        self.errorList = list()
+        self.attachmentFolder = ""
+        self.usedFilenames = set()    # attachment filenames already used in this space
+        self.filenameCounters = dict()   # filename -> next "-x" counter to try (see process_Files)
+        self.knownFiles = dict()      # url -> [subfolder, filename, filesize] (incremental backups)
+        self.resume = dict()          # job journal entry of an interrupted run
+        self.pageJournal = None
+        self.result = "waiting"
+
+    def log(self, text, end="\n"):
+        log(text, end, self)
 
 
 # ----------------------------------------------------------------------------------------
@@ -642,260 +2108,207 @@ def write_to_file(data,filename):
         print(data, file=f)
 
 
-# ----------------------------------------------------------------------------------------
-# FUNCTIONs that help me analyze what takes the most time
-performanceReport = "Performance Report - Space Archive Script \n "
-performanceReport += "----------------------------------------------------"
-_start_time = time.time()
-def startTimer():
-    global _start_time
-    _start_time = time.time()
-def stopTimer(description):
-    t_sec = round(time.time() - _start_time,2)
-    global performanceReport
-    performanceReport += f"\n {t_sec:5.2f} " + description
-
-
-# ------------------------------------------------------------------------
-#    Start of non-function code !  #lastfunction
-#
-# ------------------------------------------------------------------------
-
-# ------------------------------------------------------------------------------ start process ----------------------------------------------------------------------
-
-# ===== GET SPACES
-chat_ids, group_ids = get_searchspaces(myToken)
-print(f"Direct chats found: {len(chat_ids)}    Group chats found: {len(group_ids)} ")
+folderLock = threading.Lock()
 
-backup_scope_string = """\nDo you want to back up one-on-one chats only (1), group chats only (2) or both one-on-one and groups (3)?
-Please type a number: """
-backup_scope = input(backup_scope_string).strip()
-while backup_scope not in ['1', '2', '3']:
-    print("Your input was not recognised as 1, 2 or 3. Please try again:")
-    backup_scope = input(backup_scope_string).strip()
-if backup_scope == "1":
-    all_ids = chat_ids
-elif backup_scope == "2":
-    all_ids = group_ids
-elif backup_scope == "3":
-    all_ids = {**chat_ids, **group_ids}
-
-# all_ids = remove_empty_spaces(myToken, all_ids)
-
-print('Backing up the following chats:')
-print(list(all_ids.keys()))
-
-# =====  GET OWN DETAILS 
-
-try:
-    myOwnDetails = get_me(myToken)
-    myEmail = "".join(myOwnDetails['emails'])
-    myName = myOwnDetails['displayName']
-    myDomain = myEmail.split("@")[1]
-except Exception as e:
-    print("Retrieving own details: **ERROR** : " + str(e))
 
-
-# ===== GET FILE SETTINGS
-file_scope_string = """\nDo you want to download only images (1) or all files (2)?
-If you are downloading all chats, I recommend images only (1) to speed up the process, but you can do a full backup with (2).
-Please type a number: """
-file_scope = input(file_scope_string).strip()
-while file_scope not in ['1', '2']:
-    print("Your input was not recognised as 1 or 2. Please try again:")
-    file_scope = input(file_scope_string).strip()
-if file_scope == '1':
-    downloadFiles = 'images'
-elif file_scope == '2':
-    downloadFiles = 'files'
-
-# ===== PRINT PARAMETERS
-if msgMaxAge == 0:
-    maxMessageString = str(maxTotalMessages)
-else:
-    maxMessageString = str(msgMaxAge) + " days"
-if sortOldNew:
-    sortOldNewString = 'Old to new'
-else:
-    sortOldNewString = 'New to old'
-
-print(f"""\n\n #0 ----- PARAMETERS:
-Download: {downloadFiles} - Max messages: {maxMessageString} - Avatars: {userAvatar} - Sorting: {sortOldNewString} - extra output: {outputToJson}""")
-
-
-# ------------------------------- start loop --------------------------------
-print("\n\n ========================= START =========================")
-for name, id in all_ids.items():
-    myRoom = id
+# ----------------------------------------------------------------------------------------
+# FUNCTION that backs up one space: name -> messages -> members -> avatars -> HTML.
+#          All state of the space is kept in 'space' (a SpaceState) and local variables.
+def backup_space(space):
+    myRoom = space.roomId
+    checkpoint = load_checkpoint(myRoom) if incrementalBackup else None
+    resume = space.resume
+    space.pageJournal = PageJournal(myRoom, resume.get('state') in ['running', 'failed'])
 
     # =====  CHECK FOR EMPTY SPACES ================================================
-    #   if there are no messages in the space (possible if it only contains calls), skip this space
-    if check_empty_space(myToken, myRoom):
-        continue
+    #   the first page of messages tells if there are no messages in the space (possible if it
+    #   only contains calls): skip this space. The other pages are retrieved in step #2.
+    metrics.start("get first messages")
+    messagePages = get_message_pages(webexAPI, myRoom, 900, checkpoint, space.pageJournal, space.created)
+    try:
+        firstPage = next(messagePages, [])
+    except EmptySpace:
+        log("          This space has no messages, removing from backup.")
+        return "skipped (no messages)"
+    except Exception as e:
+        log(" **ERROR** STEP #2: getting Messages")
+        log("             Error message: " + str(e))
+        beep(3)
+        raise SpaceFailed("getting messages: " + str(e))
+    metrics.stop()
 
     # =====  GET SPACE NAME ========================================================
     #   used for the space name in the header and optionally the output foldername
-    startTimer()
+    metrics.start("get space name")
     try:
-        roomName = get_roomname(myToken, myRoom)
-        print(" #1 ----- Get space name: '" + roomName + "'")
+        roomName = get_roomname(webexAPI, myRoom)
+        log(" #1 ----- Get space name: '" + roomName + "'")
     except Exception as e:
-        print(" #1 ----- Get space name: **ERROR** getting space name")
-        print("             Error message: " + str(e))
+        log(" #1 ----- Get space name: **ERROR** getting space name")
+        log("             Error message: " + str(e))
         beep(3)
-        leave()
-    stopTimer("Get Space Name")
+        raise SpaceFailed("getting the space name: " + str(e))
+    metrics.stop()
 
     outputFileName = format_filename(roomName)
-    myAttachmentFolder = os.path.join(runDir, outputFileName)
+    space.attachmentFolder = os.path.join(runDir, outputFileName)
 
+    # =====  INCREMENTAL BACKUP: continue from the checkpoint of the previous run ==
+    if checkpoint is not None:
+        outputFileName = checkpoint['outputFileName']
+        space.attachmentFolder = checkpoint['folder']
+        space.knownFiles = checkpoint['files']
+        space.usedFilenames = set(f[0] + f[1] for f in space.knownFiles.values() if f[0] != "")
 
+    # =====  INTERRUPTED RUN: continue in the folder of the previous attempt =========
+    if 'folder' in resume:
+        outputFileName = resume['outputFileName']
+        space.attachmentFolder = resume['folder']
 
     # =====  GET MESSAGES ==========================================================
-    startTimer()
-    print(" #2 ----- Get messages")
+    metrics.start("get messages")
+    log(" #2 ----- Get messages")
+    #   pages go to the message spool as they arrive; the file info of their attachments is
+    #   requested in the download pool at the same time
+    spool = MessageSpool()
+    fileInfo = dict()
     try:
-        WebexTeamsMessages = get_messages(myToken, myRoom, 900)
+        for page in itertools.chain([firstPage], messagePages):
+            spool.add_page(page)
+            prefetch_fileinfo(space, page, fileInfo)
+        if checkpoint is not None:
+            if spool.messageCount == 0:
+                return "unchanged (no new messages)"
+            newIds = set(msg['id'] for msg in spool.iter_newest_first())
+            for page in get_stored_message_pages(myRoom, 900, newIds):
+                spool.add_page(page)
+                prefetch_fileinfo(space, page, fileInfo)
     except Exception as e:
-        print(" **ERROR** STEP #2: getting Messages")
-        print("             Error message: " + str(e))
+        log(" **ERROR** STEP #2: getting Messages")
+        log("             Error message: " + str(e))
         beep(3)
-        leave()
-    stopTimer("get messages")
+        raise SpaceFailed("getting messages: " + str(e))
+    metrics.stop()
+    if spool.messageCount == 0:
+        log(" **ERROR** there are no messages. Please check your maxMessages setting and try again.")
+        return "skipped (no messages within the max messages setting)"
 
 
     # ===== CREATE USERLIST ========================================================
     #   Collect only userId's of users who wrote a message. For those users we will
     #   retrieve details & download/link avatars
-    startTimer()
-    uniqueUserIds = list()
-    uniqueUserMails = list()
-    for myUser in WebexTeamsMessages:
-        if myUser['personId'] not in uniqueUserIds:
-            uniqueUserIds.append(myUser['personId'])
-            uniqueUserMails.append(myUser['personEmail'])
-    stopTimer("get unique user ids")
+    #   (collected by the message spool)
+    uniqueUserIds = spool.uniqueUserIds
+    uniqueUserMails = spool.uniqueUserMails
 
    
 
     # =====  GET MEMBER NAMES ======================================================
-    # myMembers used # of space members (stats).
-    # myMemberList is used to get the displayName of users (msg only show email address - personEmail)
-    startTimer()
-    print(" #3 ----- Get member list") # Put ALL members in a dictionary that contains: "email + fullname"
+    # memberCount used # of space members (stats).
+    # space.memberList is used to get the displayName of users (msg only show email address - personEmail)
+    metrics.start("get memberlist")
+    log(" #3 ----- Get member list") # Put ALL members in a dictionary that contains: "email + fullname"
+    memberCount = 0
     try:
-        myMembers = get_memberships(myToken, myRoom, 500)
-        for members in myMembers:
-            try:
-                myMemberList[str(members['personEmail'])] = str(members['personDisplayName'])
-            except Exception as e:  # IF there's no personDisplayName, use email
-                myMemberList[str(members['personEmail'])] = str(members['personEmail'])
+        space.memberList, memberCount = membershipCache.get_members(webexAPI, myRoom, space.lastActivity)
     except Exception as e:
-        print(" **ERROR** STEP #3: getting Memberlist (email address)")
-        print("             Error message: " + str(e))
+        log(" **ERROR** STEP #3: getting Memberlist (email address)")
+        log("             Error message: " + str(e))
         beep(1)
-    stopTimer("get memberlist")
+    metrics.stop()
 
  # =====  HANDLE DELETED USERS ==================================================
     # Chats with deleted users will have 'Empty Title' as their title and don't show the deleted user space members. 
     # We can extract the name from the sent messages.
 
-    if 'Empty Title' in roomName:
+    if 'Empty Title' in roomName and checkpoint is None and 'folder' not in resume:
         backup_email = next(unique_email for unique_email in uniqueUserMails if unique_email != myEmail) 
         roomName = backup_email.partition('@')[0] + "_old"
         outputFileName = format_filename(roomName)
-        myAttachmentFolder = os.path.join(runDir, outputFileName)
-        print(f"          Chat with deleted user detected. Using name from email ({outputFileName}) instead.")
+        space.attachmentFolder = os.path.join(runDir, outputFileName)
+        log(f"          Chat with deleted user detected. Using name from email ({outputFileName}) instead.")
 
     # =====  CREATE FOLDERS FOR ATTACHMENTS & AVATARS ==============================
-    startTimer()
-    print(f" #4 ----- Create backup folder")
-    if os.path.exists(myAttachmentFolder):
-        # If folder already exists, check folder-01, etc., until we can create a new folder.
-        folderCounter = 1
-        print(f"          Folder already exists. Checking if {myAttachmentFolder}-{folderCounter:02d} exists!")
-        while os.path.exists(f"{myAttachmentFolder}-{folderCounter:02d}"):
-            folderCounter += 1
-        myAttachmentFolder += f"-{folderCounter:02d}"
-    print("          Attachment Folder: " + myAttachmentFolder)
-    os.makedirs(myAttachmentFolder)
+    metrics.start("create folders")
+    log(f" #4 ----- Create backup folder")
+    with folderLock:   # spaces running at the same time may want the same folder name
+        if checkpoint is not None:
+            log("          Incremental backup, using existing folder")
+        elif 'folder' in resume:
+            log("          Continuing an interrupted backup, using existing folder")
+        elif os.path.exists(space.attachmentFolder):
+            # If folder already exists, check folder-01, etc., until we can create a new folder.
+            folderCounter = 1
+            log(f"          Folder already exists. Checking if {space.attachmentFolder}-{folderCounter:02d} exists!")
+            while os.path.exists(f"{space.attachmentFolder}-{folderCounter:02d}"):
+                folderCounter += 1
+            space.attachmentFolder += f"-{folderCounter:02d}"
+        os.makedirs(space.attachmentFolder, exist_ok=True)
+    log("          Attachment Folder: " + space.attachmentFolder)
+    jobJournal.update(myRoom, folder=space.attachmentFolder, outputFileName=outputFileName)
     if userAvatar == "download":
-        os.makedirs(myAttachmentFolder + "/avatars/")
+        os.makedirs(space.attachmentFolder + "/avatars/", exist_ok=True)
     if downloadFiles == "files":
-        os.makedirs(myAttachmentFolder + "/files/")
-        os.makedirs(myAttachmentFolder + "/images/")
+        os.makedirs(space.attachmentFolder + "/files/", exist_ok=True)
+        os.makedirs(space.attachmentFolder + "/images/", exist_ok=True)
     if downloadFiles == "images":
-        os.makedirs(myAttachmentFolder + "/images/")
-    stopTimer("create folders")
+        os.makedirs(space.attachmentFolder + "/images/", exist_ok=True)
+    metrics.stop()
 
 
 
     # =====  GET MEMBER AVATARS ====================================================
-    startTimer()
+    metrics.start("get avatars")
     if userAvatar == "link" or userAvatar == "download":
-        print(f" #5a ---- Avatars: collecting info of {len(uniqueUserIds)} avatars   ", end='', flush=True)
-        userAvatarDict = dict()  # userAvatarDict[your@email.com] = "https://webexteamsavatarurl"
-        x=0
-        y=len(uniqueUserIds)
-        if 80 > y:
-            chunksize = y
-        else:
-            chunksize = 80
-        if y < 80:
-            chunksize = y
+        log(f" #5a ---- Avatars: collecting info of {len(uniqueUserIds)} avatars   ", end='')
+        userAvatarDict = dict()  # userAvatarDict[personId] = "https://webexteamsavatarurl"
         try:
-            for i in range(x,y,chunksize): # - LOOPING OVER MemberDataList
-                x=i
-                abc = get_persondetails(myToken, uniqueUserIds[x:x+chunksize])
-                print(".", end='', flush=True)  # Progress indicator
-                for persondetails in abc:
-                    try:
-                        userAvatarDict[persondetails['id']] = persondetails['avatar'].replace("~1600","~80")
-                    except:
-                        pass
+            userAvatarDict = personCache.get_avatars(webexAPI, uniqueUserIds)
         except:
             pass
-    stopTimer("get avatars")
-    print("")
-    startTimer()
+    metrics.stop()
+    log("")
+    metrics.start("download avatars")
     try:
         if userAvatar == "link" or userAvatar == "download":
-            print(f" #5b ---- Avatars: {userAvatar}ing {len(userAvatarDict)} avatars")
+            log(f" #5b ---- Avatars: {userAvatar}ing {len(userAvatarDict)} avatars")
             if userAvatar == "download":
-                download_avatars(userAvatarDict)
+                download_avatars(space, userAvatarDict)
     except:
         pass
-    stopTimer("download avatars")
+    metrics.stop()
 
 
     # =====  SET/CREATE VARIABLES ==================================================
     tocList = "<div class=''>"
     statTotalFiles = 0
     statTotalImages = 0
-    statTotalMessages = len(WebexTeamsMessages)
+    statTotalMessages = spool.messageCount
     myDomainStats = dict()
     statMessageMonth = dict()
     previousEmail = ""
     previousMonth = ""
-    previousMsgCreated = ""
-    UTChourDelta = timeDeltaWithUTC()
+    previousMsg = None
     TimezoneName = str(time.tzname)
 
 
 
     # ====== WRITE JSON data to a FILE =============================================
     #   (optional) Write JSON to a FILE to be used as input (not using the Webex Teams APIs)
-    startTimer()
+    metrics.start("output to json")
     if outputToJson == "yes" or outputToJson == "both" or outputToJson == "json":
-        with open(myAttachmentFolder + "/" + outputFileName + ".json", 'w', encoding='utf-8') as f:
-            json.dump(WebexTeamsMessages, f)
-    stopTimer("output to json")
+        with open(space.attachmentFolder + "/" + outputFileName + ".json", 'w', encoding='utf-8') as f:
+            f.write("[")
+            for msgNumber, msg in enumerate(spool.iter_newest_first()):
+                f.write((", " if msgNumber > 0 else "") + message_json(msg))
+            f.write("]")
+    metrics.stop()
 
 
 
     # ======  GENERATE HTML HEADER =================================================
     #
-    print(" #6 ----- Generate HTML header")
+    log(" #6 ----- Generate HTML header")
     
     htmlheader = """<!DOCTYPE html><html><head><meta charset="utf-8"/><style type='text/css'>
     body { font-family: 'HelveticaNeue', 'Helvetica Neue', 'Helvetica', 'Arial', 'Lucida Grande', 'sans-serif';
@@ -1179,104 +2592,62 @@ for name, id in all_ids.items():
     # ====== GENERATE FINAL HTML ===================================================
     #  for all messages (and optionally a .txt file with all messages)
     #
-    startTimer()
-    print(" #7 ----- Download files and generate HTML code for each message")
-    htmldata = ""
-    textOutput = ""
+    metrics.start("generate HTML")
+    log(" #7 ----- Download files and generate HTML code for each message")
+    # the message HTML is streamed to a temporary file, the .txt directly to its file
+    htmlBody = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+    textFile = None
     if outputToText:
-        textOutput += f"------------------------------------------------------------\n {roomName}\n------------------------------------------------------------\nCREATED:        {currentDate}\nFile Download:  {downloadFiles.upper()}\nGenerated by:   {myName}\nSort old-new:   " + str(sortOldNew).replace("True", "yes (default)").replace("False", "no") + f"\nMax messages:   {maxMessageString}\nAvatar:         {userAvatar} \nversion:        {version} \nTimezone:           {TimezoneName}"
+        textFile = open(space.attachmentFolder + "/" + outputFileName + ".txt", 'w', encoding='utf-8')
+        textFile.write(f"------------------------------------------------------------\n {roomName}\n------------------------------------------------------------\nCREATED:        {currentDate}\nFile Download:  {downloadFiles.upper()}\nGenerated by:   {myName}\nSort old-new:   " + str(sortOldNew).replace("True", "yes (default)").replace("False", "no") + f"\nMax messages:   {maxMessageString}\nAvatar:         {userAvatar} \nversion:        {version} \nTimezone:           {TimezoneName}")
 
     if downloadFiles == 'images':
-        print("          Downloading image attachments   ", end = '', flush = True)
+        log("          Downloading image attachments   ", end='')
     if downloadFiles == 'files':
-        print("          Downloading all attachments    ", end = '', flush = True)
+        log("          Downloading all attachments    ", end='')
     statTotalMentions = 0
 
-    startTimer()
-    sortedMessages = sorted(WebexTeamsMessages, key = lambda i: i['created'], reverse = False)
-    stopTimer("Sort WebexTeamsMessages")
-
-    startTimer()
-    # --- Message order table: create
-    msgOrderTable = create_threading_order_table(sortedMessages)
-    stopTimer("Create Threading order table")
-
-    # --- Sort Messages: process all msgs defined by the "threading index"-table order
-    if sortOldNew:
-        abc = sorted(msgOrderTable , key = lambda x : (float(x),-int(float(x))))
-    else:
-        abc = sorted(msgOrderTable , key = lambda x : (-int(float(x)),float(x)))
-
-
     # --- PROCESS EVERY MESSAGE ----------------------------------------------------
-    for index, key in enumerate(abc):
-        # find matching message ID in message list
-        msg = next(item for item in WebexTeamsMessages if item["id"] == msgOrderTable[key])
-        try:
-            nextitem = float(abc[index+1])
-            previousitem = float(abc[index-1])
-            currentitem = float(abc[index])
-            if previousitem - round(previousitem) == 0 and currentitem - round(currentitem) > 0:
-                # START of threaded message!
-                threadstart = True
-            else:
-                threadstart = False
-            if currentitem - round(currentitem) > 0:
-                threaded_message = True
-            else:
-                threaded_message = False
-        except:
-            threadstart = False
-            threaded_message = False
-
+    #     in display order, read from the message spool
+    for msg, threaded_message in spool.iter_render_order(sortOldNew):
         # --- continue processing messages
         if len(msg) < 5:
             continue        # message empty
-        data_text = ""
+        htmldata = ""       # HTML of this message only
         # --- if msg was updated: add 'Edited' in date
         if "updated" in msg:
             data_msg_was_edited = True
-            data_created = convertDate(str(msg['created']),UTChourDelta) + "  Edited"
+            data_created = convertDate(msg) + "  Edited"
         else:
             data_msg_was_edited = False
-            data_created = convertDate(str(msg['created']),UTChourDelta)
-        # --- HTML in message? Deal with markdown
-        if "html" in msg:
-            # --- Check if there are Markdown hyperlinks [linktext](www.cisco.com) as these look very different
-            if "sparkBase.clickEventHandler(event)" in str(msg['html']):
-                data_text = convertMarkdownURL(str(msg['html']),1)
-                data_text = convertMarkdownURL(data_text,2)
-            else:
-                data_text = convertURL(str(msg['html']))
-                if "onClick" in msg['html']:
-                    print(data_text)
-        elif 'text' in msg:
-            data_text = convertURL(str(msg['text']))
-            if "<code>" in data_text:
-                if "</code>" not in data_text:
-                    data_text += "</code>"
+            data_created = convertDate(msg)
+        # --- links, Markdown and mentions in the message text
+        data_text = convert_message_text(msg)
+        if "html" not in msg and "<code>" in data_text:
+            if "</code>" not in data_text:
+                data_text += "</code>"
         if data_text == "" and 'files' not in msg and 'mentionedPeople' not in msg:
             # empty text without mentions or attached images/files: SKIP
             continue
         try:  # Put email & name in variable
             data_email = str(msg['personEmail'])
             data_userid = str(msg['personId'])
-            data_name = myMemberList[msg['personEmail']]
+            data_name = space.memberList[msg['personEmail']]
         except:
             data_name = data_email
         if '@' in data_email and "error.com" not in data_email:
             domain = str(data_email.split('@')[1])
             myDomainStats[domain] = myDomainStats.get(domain, 0) + 1
-        messageYear, messageMonth, messageMonthNr = get_monthday(msg['created'])
+        messageYear, messageMonth, messageMonthNr = get_monthday(msg)
         # ====== GENERATE MONTH STATISTICS
-        statMessageMonthKey = messageYear + " - " + messageMonthNr + "-" + messageMonth
+        statMessageMonthKey = message_time(msg).monthKey
         statMessageMonth[statMessageMonthKey] = statMessageMonth.get(
             statMessageMonthKey, 0) + 1
         if messageMonth != previousMonth and not threaded_message:
             htmldata += f"<div class='cssNewMonth' id='{statMessageMonthKey}'>   {messageYear}    " + \
                 messageMonth + "</div>"
             if outputToText:  # for .txt output
-                textOutput += f"\n\n---------- {messageYear}    {messageMonth} ------------------------------\n\n"
+                textFile.write(f"\n\n---------- {messageYear}    {messageMonth} ------------------------------\n\n")
         # ====== if PREVIOUS email equals current email, then skip header
         if threaded_message: # ___________________________________ start thread ______________________________
             htmldata += "<div class='css_message_thread'>"
@@ -1284,11 +2655,11 @@ for name, id in all_ids.items():
             htmldata += "<div class='css_message'>"
 
         # ====== AVATAR: + msg header: display or not
-        if (data_email != previousEmail) or (data_email == previousEmail and timedifference(msg["created"], previousMsgCreated) > 60) or (data_msg_was_edited):
+        if (data_email != previousEmail) or (data_email == previousEmail and timedifference(msg, previousMsg) > 60) or (data_msg_was_edited):
             if userAvatar == "link" and data_userid in userAvatarDict:
                 htmldata += f"<img src='{userAvatarDict[data_userid]}' class='avatarCircle'  width='36px' height='36px'/>"
             elif userAvatar == "download" and data_userid in userAvatarDict:
-                htmldata += f"<img src='avatars/" + data_userid + "' class='avatarCircle'  width='36px' height='36px'/>"
+                htmldata += f"<img src='avatars/" + avatar_filename(data_userid) + "' class='avatarCircle'  width='36px' height='36px'/>"
             else: # User that may not exist anymore --> use email as name
                 if data_name == data_email:
                     htmldata += f"<div id='avatarCircle'>{data_name[0:2].upper()}</div>"
@@ -1309,49 +2680,36 @@ for name, id in all_ids.items():
             htmldata += "<div class='css_message'>"
 
         if outputToText:  # for .txt output
-            textOutput += f"{msg['created']}  {data_email} - "
+            textFile.write(f"{msg['created']}  {data_email} - ")
 
-        # ====== DEAL WITH MENTIONS IN A MESSAGE
+        # ====== MENTIONS IN A MESSAGE (highlighted by convert_message_text)
         if 'mentionedPeople' in msg:
-            try:
-                statTotalMentions += 1
-                for item in msg['mentionedPeople']:
-                    texttoreplace = "<spark-mention data-object-type=\"person\" data-object-id=\"" + item + "\">"
-                    data_text = data_text.replace(texttoreplace,"<span style='color:red;display:inline;'>@")
-                data_text = data_text.replace("</spark-mention>","</span>")
-            except:
-                print(" **ERROR** processing mentions, don't worry, I will continue")
+            statTotalMentions += 1
         if 'mentionedGroups' in msg:
-            try:
-                statTotalMentions += 1
-                for item in msg['mentionedGroups']:
-                    texttoreplace = "<spark-mention data-object-type=\"groupMention\" data-group-type=\"" + item + "\">"
-                    data_text = data_text.replace(texttoreplace,"<span style='color:red;display:inline;'>@")
-                data_text = data_text.replace("</spark-mention>","</span>")
-            except:
-                print(" **ERROR** processing mentions, don't worry, I will continue")
+            statTotalMentions += 1
 
         htmldata += "<div class='css_messagetext'>" + data_text
         if outputToText and 'mentionedPeople' in msg:  # for .txt output
-            p = re.compile(r'<.*?>')
-            textOutput += p.sub('', data_text)
-            textOutput += "\n\r"
+            textFile.write(htmlTagPattern.sub('', data_text))
+            textFile.write("\n\r")
         if outputToText and 'mentionedPeople' not in msg:  # for .txt output
-            textOutput += f"{data_text}\n\r"
+            textFile.write(f"{data_text}\n\r")
 
         # ====== DEAL WITH FILE ATTACHMENTS IN A MESSAGE
         if 'files' in msg:
             if data_text != "":
                 htmldata += "<br>"
-            myFiles = process_Files(msg['files'])
+            myFiles = process_Files(space, msg['files'], fileInfo)
             # SORT attached files by <files> _then_ <images>
             myFiles.sort(key = lambda x: x.split("###")[0].split(".")[-1] in ['jpg','png','jpeg'])
             splitFilesImages = ""
             for filename in myFiles:
                 # IMAGE POPUP
-                filename, filesize = filename.split("###")
+                filename, filesize, *deleted = filename.split("###")   # "###deleted": no file to link
                 fileextension = os.path.splitext(filename)[1][1:].lower()
-                if fileextension in ['png', 'jpg', 'bmp', 'gif', 'tif', 'jpeg'] and (downloadFiles in ["images", "files"]):
+                if deleted:
+                    htmldata += f"<br><div id='fileicon'></div><span style='line-height:32px;'> {filename}   ({filesize})</span>"
+                elif fileextension in ['png', 'jpg', 'bmp', 'gif', 'tif', 'jpeg'] and (downloadFiles in ["images", "files"]):
                     if splitFilesImages == "":
                         # extra return after all attached files are listed
                         htmldata += "<br>"
@@ -1366,31 +2724,32 @@ for name, id in all_ids.items():
                 else:
                     statTotalFiles += 1
                 if outputToText:  # for .txt output
-                    textOutput += f"                           Attachment: {filename} ({filesize})\n"
+                    textFile.write(f"                           Attachment: {filename} ({filesize})\n")
             htmldata += "</span>"
         htmldata += "</div>"
         htmldata += "</div>"
         htmldata += "</div>"
+        htmlBody.write(htmldata)
         previousEmail = data_email
         if not threaded_message:
             previousMonth = messageMonth
-        previousMsgCreated = msg['created']
-    print("")
-    print("          Messages processed:  " + str(statTotalMessages))
-    stopTimer("generate HTML")
+        previousMsg = msg
+    metrics.stop()
+    log("")
+    log("          Messages processed:  " + str(statTotalMessages))
 
     # ======  *SORT* DOMAIN USER STATISTICS
-    startTimer()
+    metrics.start("sorting messages")
     myDomainStatsSorted = sorted(
         [(v, k) for k, v in myDomainStats.items()], reverse=True)
     myDomainStatsSorted = myDomainStatsSorted[0:10]  # only want the top 10
     returntextDomain = ""
     returntextMsgMonth = ""
-    stopTimer("sorting messages")
+    metrics.stop()
 
 
     # ======  TABLE OF CONTENTS
-    startTimer()
+    metrics.start("toc, statistics, header and footer")
     tocList += "<table id='mytoc' style='width: 95%;'>"
     if sortOldNew:
         mytest = sorted(statMessageMonth.items(), reverse=False)
@@ -1425,14 +2784,18 @@ for name, id in all_ids.items():
     tocStats += "<tr><td> # images: </td><td>" + str(statTotalImages) + "</td></tr>"
     tocStats += "<tr><td> # files: </td><td>" + str(statTotalFiles) + "</td></tr>"
     tocStats += "<tr><td># mentions: </td><td>" + str(statTotalMentions) + "</td></tr>"
-    tocStats += "<tr><td># total members: </td><td>" + str(len(myMembers)) + "</td></tr>"
+    tocStats += "<tr><td># total members: </td><td>" + str(memberCount) + "</td></tr>"
     tocStats += "<tr><td># unique members:<br>&nbsp;&nbsp;&nbsp;<span style='font-size:11px;'>(in this archive)</span> </td><td>" + str(len(uniqueUserIds)) + "</td></tr>"
+    metrics.count("messages", statTotalMessages)
+    metrics.count("files", statTotalFiles)
+    metrics.count("images", statTotalImages)
     # if not ALL messages have been archived: show message
-    if statTotalMessages > maxTotalMessages -10:
+    if statTotalMessages > maxMessageCount -10:
         tocStats += "<tr><td colspan='2'><br><span style='color:grey;font-size:10px;'>space contains more than " + str(statTotalMessages) + " messages</span></td></tr>"
     tocStats += "</table>"
     if outputToText:  # for .txt output
-        textOutput += f"\n\n\n STATISTICS \n--------------------------\n # of messages : {statTotalMessages}\n # of images   : {statTotalImages}\n # of files    : {statTotalFiles}\n # of mentions : {statTotalMentions}\n\n\n"
+        textFile.write(f"\n\n\n STATISTICS \n--------------------------\n # of messages : {statTotalMessages}\n # of images   : {statTotalImages}\n # of files    : {statTotalFiles}\n # of mentions : {statTotalMentions}\n\n\n\n")
+        textFile.close()
 
     # ======  HEADER
     newtocList = "<table class='myheader' id='myheader'> <tr>"
@@ -1480,35 +2843,426 @@ for name, id in all_ids.items():
     # ======  FOOTER
     htmlfooter = "<br><br><div class='cssNewMonth' id='endoffile'> end of file &nbsp;&nbsp;<span style='float:right; font-size:16px; margin-right:15px; padding-top:24px;'><a href='#top'>back to top</a></span></div><br><br>"
 
-    # ======  PUT EVERYTHING TOGETHER
-    print(" #8 ----- Finalizing HTML")
-    htmldata = htmlheader + newtocList + htmldata + htmlfooter + imagepopuphtml + "</body></html>"
-    stopTimer("toc,domainstats,header,footer + combining")
+    metrics.stop()
 
 
     # ======  WRITE HTML to FILE
-    startTimer()
-    with open(myAttachmentFolder + "/" + outputFileName + ".html", 'w', encoding='utf-8') as f:
-        print(htmldata, file=f)
-    print("------------------------- ready -------------------------\n\n")
+    #  header and TOC are only known after all messages are processed: write them first,
+    #  then copy the streamed message HTML behind them
+    metrics.start("write html to file")
+    log(" #8 ----- Finalizing HTML")
+    with open(space.attachmentFolder + "/" + outputFileName + ".html", 'w', encoding='utf-8') as f:
+        f.write(htmlheader + newtocList)
+        htmlBody.seek(0)
+        shutil.copyfileobj(htmlBody, f)
+        f.write(htmlfooter + imagepopuphtml + "</body></html>\n")
+    htmlBody.close()
+    log("------------------------- ready -------------------------\n\n")
     # beep(1)
-    stopTimer("write html to file")
+    metrics.stop()
+
+    if incrementalBackup:
+        save_checkpoint(space, outputFileName, spool)
+    spool.close()
+    return f"done ({statTotalMessages} messages)"
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that runs the backup of one space in a worker thread. Errors (SpaceFailed or any
+#          other) only stop this space, the other spaces continue.
+def run_space_backup(space):
+    spaceContext.space = space
+    space.resume = jobJournal.space(space.roomId)
+    jobJournal.update(space.roomId, state="running")
+    try:
+        with metrics.span("backup space"):
+            space.result = backup_space(space)
+    except BaseException as e:
+        space.result = "failed"
+        space.errorList.append("def backup_space stopped with error: " + repr(e))
+    finally:
+        spaceContext.space = None
+    if space.pageJournal is not None:
+        if space.result == "failed":
+            space.pageJournal.close()   # kept to continue the space in the next run
+        else:
+            space.pageJournal.remove()
+    jobJournal.update(space.roomId, state="failed" if space.result == "failed" else "done", result=space.result,
+                      lastActivity=space.lastActivity)
+    return space
 
-# ------------------------------- end of loop ------------------------------
 
-if len(myErrorList) > 0 and printErrorList:
-    print("    -------------------- Error Messages ---------------------")
-    for myerrors in myErrorList:
-        print(" > " + myerrors)
+# ----------------------------------------------------------------------------------------
+# FUNCTION that checks if a space that is done in the job journal had no activity since: the
+#          lastActivity of the space list was not newer when it was backed up. Spaces with new
+#          messages are backed up again, also when the journal of the run is kept for days
+#          because another space keeps failing.
+def previous_attempt_current(previousAttempt, room):
+    return room['lastActivity'] != "" and room['lastActivity'] <= previousAttempt.get('lastActivity', "")
 
 
-if printPerformanceReport:
-    print("    -------------------- Performance ---------------------")
-    print(performanceReport)
+# ----------------------------------------------------------------------------------------
+# FUNCTION that backs up the spaces in 'rooms' (space name, space ID, details), like get_searchspaces()
+#          yields them, spaceWorkers spaces at the same time. The first spaces are backed up while
+#          'rooms' is still loading. Reports the progress per space, returns the list of SpaceStates
+#          (with result and errors).
+#          With a manifest (incremental backups) unchanged spaces are skipped and the manifest
+#          is updated after every space. Spaces that are done in the job journal (interrupted run)
+#          are skipped when they had no activity since. The caches are saved at most once a minute, so an interrupted run keeps them.
+def backup_spaces(rooms, manifest=None):
+    spaces = list()
+    roomDetails = dict()
+    doneCount = 0
+    runningCount = 0
+    lastSave = time.monotonic()
+    finished = queue.Queue()   # futures of the spaces that are done, in the order they finish
+    listed = False
+
+    def print_progress(space):
+        if isinstance(rooms, list) or listed:
+            spaceTotal = str(len(rooms) if isinstance(rooms, list) else len(spaces))
+        else:
+            spaceTotal = str(len(spaces)) + "+"   # more spaces may still be listed
+        print(f" [{doneCount}/{spaceTotal}] {space.name}: {space.result}", flush=True)
+
+    def space_done(space):
+        nonlocal doneCount, lastSave
+        doneCount += 1
+        print_progress(space)
+        if manifest is not None and space.result != "failed":
+            manifest['rooms'][space.roomId] = dict(roomDetails[space.roomId], id=space.roomId, lastBackup=jobJournal.started)
+            save_manifest(manifest)
+        if time.monotonic() - lastSave > 60:
+            save_caches()
+            lastSave = time.monotonic()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=spaceWorkers) as executor:
+        for name, roomId, details in rooms:
+            space = SpaceState(name, roomId, details['lastActivity'], details.get('created', ""))
+            spaces.append(space)
+            roomDetails[roomId] = details
+            previousAttempt = jobJournal.space(space.roomId)
+            if previousAttempt.get('state') == "done" and previous_attempt_current(previousAttempt, details):
+                space.result = previousAttempt['result'] + " (previous attempt)"
+                doneCount += 1
+                print_progress(space)
+            elif manifest is not None and space_unchanged(manifest, space.roomId, details):
+                space.result = "unchanged (no activity since last backup)"
+                doneCount += 1
+                print_progress(space)
+            else:
+                executor.submit(run_space_backup, space).add_done_callback(finished.put)
+                runningCount += 1
+            while not finished.empty():   # spaces that are done while the list is loading
+                space_done(finished.get().result())
+                runningCount -= 1
+        listed = True
+        while runningCount > 0:
+            space_done(finished.get().result())
+            runningCount -= 1
+    return spaces
 
-if outputToText:
-    with open(myAttachmentFolder + "/" + outputFileName + ".txt", 'w', encoding='utf-8') as f:
-        print(textOutput, file=f)
 
+# ----------------------------------------------------------------------------------------
+# FUNCTION that saves the person, membership and attachment caches
+def save_caches():
+    personCache.save()
+    membershipCache.save()
+    attachmentStore.save()
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that converts a setting from the config file or the command line (text) to the type
+#          of the default value of the setting: True/False (also yes/no, 1/0), a number or text.
+#          maxTotalMessages can also be a number of days, like 60d
+def parse_setting(name, value):
+    default = globals()[name]
+    value = value.strip().strip("'\"")
+    if isinstance(default, bool):
+        if value.lower() in ['true', 'yes', '1']:
+            return True
+        if value.lower() in ['false', 'no', '0']:
+            return False
+        raise ValueError(f"the '{name}' setting must be: True or False")
+    if isinstance(default, (int, float)):
+        if name == 'maxTotalMessages' and value.endswith("d"):
+            return value
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        try:
+            return float(value)
+        except ValueError:
+            raise ValueError(f"the '{name}' setting must be a number")
+    return value
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that reads the settings from the [webex-backup] section of a config file, like:
+#              [webex-backup]
+#              token = ...
+#              backupScope = all
+#              downloadFiles = images
+#          Returns a dict with the settings. A missing file is only an error when it is required.
+def read_config_file(filename, required=True):
+    if not required and not os.path.exists(filename):
+        return dict()
+    config = configparser.ConfigParser(interpolation=None)
+    config.optionxform = str   # the setting names are case sensitive
+    with open(filename, 'r', encoding='utf-8') as f:
+        config.read_file(f)
+    if not config.has_section('webex-backup'):
+        raise ValueError(f"the config file {filename} has no [webex-backup] section")
+    settings = dict()
+    for name, value in config.items('webex-backup'):
+        if name == 'token':
+            settings['token'] = value.strip()
+        elif name in configSettings:
+            settings[name] = parse_setting(name, value)
+        else:
+            raise ValueError(f"unknown setting '{name}' in the config file {filename}")
+    return settings
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that changes the settings (see CONFIGURATIONS), like configure({'downloadFiles': 'images'})
+def configure(settings):
+    for name, value in settings.items():
+        if name not in configSettings:
+            raise ValueError(f"unknown setting '{name}'")
+        globals()[name] = value
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that reads the command line arguments
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Back up your Webex spaces: one HTML file per space, with its attachments.",
+                                     epilog="Settings that are not given on the command line come from the config file "
+                                            "(webex-backup.ini next to the script, or --config FILE) or the CONFIGURATIONS section of the script.")
+    parser.add_argument('token', nargs='?', help="your personal access token (can also be set in WEBEX_TOKEN or in the config file)")
+    parser.add_argument('--config', metavar='FILE', help="read the settings from this config file")
+    parser.add_argument('--batch', action='store_true', help="never ask anything, for unattended runs (like cron). Without --scope all spaces are backed up")
+    parser.add_argument('--scope', dest='backupScope', choices=['direct', 'group', 'all'], help="which spaces to back up")
+    parser.add_argument('--files', dest='downloadFiles', choices=['no', 'images', 'files'], help="which attachments to download")
+    parser.add_argument('--max-messages', dest='maxTotalMessages', metavar='N|Nd', help="max. number of messages per space, or max. age in days (like 60d)")
+    parser.add_argument('--avatars', dest='userAvatar', choices=['no', 'link', 'download'], help="show, link or download the user avatars")
+    parser.add_argument('--sort', choices=['old-new', 'new-old'], help="sort the messages from old to new or new to old")
+    parser.add_argument('--output', dest='outputToJson', choices=['no', 'yes', 'both', 'txt', 'json'], help="extra .txt and/or .json output")
+    parser.add_argument('--incremental', dest='incrementalBackup', action='store_true', default=None, help="only add the new messages to the previous backup")
+    parser.add_argument('--backup-folder', dest='backupFolder', metavar='FOLDER', help="create the backups in this folder")
+    parser.add_argument('--metrics', dest='metricsReport', choices=['no', 'json', 'csv', 'both'], help="write a performance report of the run")
+    parser.add_argument('--space-workers', dest='spaceWorkers', type=int, metavar='N', help="number of spaces that are backed up at the same time")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help="change any other setting, like --set downloadWorkers=4")
+    return parser.parse_args(argv)
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION that backs up the spaces: the whole run, with the current settings (see configure()).
+#          backup_scope: '1' one-on-one chats, '2' group chats, '3' both, '' ask.
+#          askFiles: ask if only images or all files should be downloaded.
+#          Returns the list of SpaceStates (with result and errors).
+#          spaceListComplete is False after a run in which the list of spaces could not be retrieved completely.
+def run_backup(token, backup_scope='3', askFiles=False):
+    global webexAPI, downloadPool, personCache, membershipCache, attachmentStore, jobJournal, metrics
+    global myEmail, myName, myDomain, downloadFiles, currentDate, runStartTime, spaceListComplete
+    settingsError = check_settings()
+    if settingsError:
+        raise ValueError(settingsError)
+    currentDate = datetime.datetime.now().strftime("%x %X")
+    runStartTime = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")[:-4] + "Z"
+    os.makedirs(runDir, exist_ok=True)
+    metrics = Metrics()
+
+    # ===== SHARED API CLIENT
+    webexAPI = WebexAPI(token, apiBaseURL, apiPoolSize, apiRequestsPerSecond, apiMaxRetries, (apiConnectTimeout, apiReadTimeout))
+    downloadPool = DownloadPool(downloadWorkers, downloadMaxPerHost, downloadMaxBandwidth)
+    personCache = PersonCache(stateFolder, personCacheDays, apiReadTimeout)
+    membershipCache = MembershipCache(stateFolder, personCacheDays > 0)
+    attachmentStore = AttachmentStore(os.path.join(stateFolder, "files"), useAttachmentStore)
+
+    # =====  GET OWN DETAILS
+    try:
+        myOwnDetails = get_me(webexAPI)
+        myEmail = "".join(myOwnDetails['emails'])
+        myName = myOwnDetails['displayName']
+        myDomain = myEmail.split("@")[1]
+    except Exception as e:
+        print("Retrieving own details: **ERROR** : " + str(e))
+
+    # ===== GET SPACES
+    #   the spaces are listed while they are backed up, unless we have to ask which ones first
+    listStatus = dict()
+    if incrementalBackup:
+        manifest = load_manifest()
+        rooms = get_searchspaces(webexAPI, manifest_cutoff(manifest), listStatus)
+    else:
+        manifest = None
+        rooms = get_searchspaces(webexAPI, status=listStatus)
+    if backup_scope not in ['1', '2', '3']:
+        with metrics.span("get spaces"):
+            rooms = list(rooms)
+        print(f"Direct chats found: {sum(details['type'] == 'direct' for _, _, details in rooms)}    Group chats found: {sum(details['type'] == 'group' for _, _, details in rooms)} ")
+
+    backup_scope_string = """\nDo you want to back up one-on-one chats only (1), group chats only (2) or both one-on-one and groups (3)?
+Please type a number: """
+    while backup_scope not in ['1', '2', '3']:
+        if backup_scope != '':
+            print("Your input was not recognised as 1, 2 or 3. Please try again:")
+        backup_scope = input(backup_scope_string).strip()
+    spaceTypes = {'1': ['direct'], '2': ['group'], '3': ['direct', 'group']}[backup_scope]
+    if isinstance(rooms, list):
+        rooms = [room for room in rooms if room[2]['type'] in spaceTypes]
+        print('Backing up the following chats:')
+        print([name for name, _, _ in rooms])
+    else:
+        rooms = (room for room in rooms if room[2]['type'] in spaceTypes)
+
+    # ===== GET FILE SETTINGS
+    if askFiles:
+        file_scope_string = """\nDo you want to download only images (1) or all files (2)?
+If you are downloading all chats, I recommend images only (1) to speed up the process, but you can do a full backup with (2).
+Please type a number: """
+        file_scope = input(file_scope_string).strip()
+        while file_scope not in ['1', '2']:
+            print("Your input was not recognised as 1 or 2. Please try again:")
+            file_scope = input(file_scope_string).strip()
+        if file_scope == '1':
+            downloadFiles = 'images'
+        elif file_scope == '2':
+            downloadFiles = 'files'
+
+    # ===== PRINT PARAMETERS
+    if sortOldNew:
+        sortOldNewString = 'Old to new'
+    else:
+        sortOldNewString = 'New to old'
+
+    print(f"""\n\n #0 ----- PARAMETERS:
+Download: {downloadFiles} - Max messages: {maxMessageString} - Avatars: {userAvatar} - Sorting: {sortOldNewString} - extra output: {outputToJson}""")
+
+    # ===== JOB JOURNAL: continue an interrupted run with the same settings
+    jobJournal = JobJournal(os.path.join(stateFolder, "journal.json"),
+                            {'scope': backup_scope, 'downloadFiles': downloadFiles, 'maxMessages': maxMessageString, 'userAvatar': userAvatar,
+                             'sortOldNew': sortOldNew, 'outputToJson': outputToJson, 'incrementalBackup': incrementalBackup})
+    if jobJournal.resumed:
+        print(f" Continuing the interrupted run of {jobJournal.started} (remove {jobJournal.filename} to start over)")
+
+    # ------------------------------- start loop --------------------------------
+    print("\n\n ========================= START =========================")
+    with metrics.span("backup spaces"):
+        allSpaces = backup_spaces(rooms, manifest)
+    with metrics.span("save caches"):
+        save_caches()
+    spaceListComplete = listStatus.get('complete', False)   # a truncated list is never a complete backup
+    if spaceListComplete and all(space.result != "failed" for space in allSpaces):
+        jobJournal.finish()
+        attachmentStore.remove_downloads()
+        if manifest is not None:
+            # all spaces of these types are backed up: next run only has to list spaces with newer activity
+            for spaceType, scopes in [('direct', ['1', '3']), ('group', ['2', '3'])]:
+                if backup_scope in scopes:
+                    manifest['complete'][spaceType] = jobJournal.started
+            save_manifest(manifest)
+    else:
+        print(" Not all spaces were backed up: run again with the same settings to continue.")
+
+    # ------------------------------- end of loop ------------------------------
+
+    myErrorList = list()
+    for space in allSpaces:
+        for myerrors in space.errorList:
+            myErrorList.append(space.name + ": " + myerrors)
+    if len(myErrorList) > 0 and printErrorList:
+        print("    -------------------- Error Messages ---------------------")
+        for myerrors in myErrorList:
+            print(" > " + myerrors)
+
+    print(" " + webexAPI.rateLimiter.report())
+    print(" " + personCache.report())
+    print(" " + membershipCache.report())
+    if downloadFiles != "no":
+        print(" " + attachmentStore.report())
+
+    metrics.count("seconds throttled", round(webexAPI.rateLimiter.timeThrottled, 3))
+    if metricsReport != 'no':
+        reportFiles = metrics.write_report(os.path.join(stateFolder, "reports"), "run-" + re.sub(r'[^0-9T]', '', runStartTime[:19]), metricsReport, allSpaces,
+                                           {'version': version, 'started': runStartTime, 'journalStarted': jobJournal.started,
+                                            'settings': {name: globals()[name] for name in configSettings}})
+        print(" Performance report: " + ", ".join(reportFiles))
+    if printPerformanceReport:
+        print("    -------------------- Performance ---------------------")
+        print(metrics.report())
+    return allSpaces
+
+
+# ----------------------------------------------------------------------------------------
+# FUNCTION for running the script: reads the config file and the command line, asks what is
+#          missing (not in --batch mode) and runs the backup.
+#          Returns the exit code: 0 when all spaces are backed up, 1 if not, 2 for wrong settings.
+def main(argv=None):
+    global pauseOnExit
+    args = parse_arguments(argv)
+    if getattr(sys, 'frozen', False):
+        print(f"Webex backup v{version} is being run in single-file executable mode")
+        pauseOnExit = not args.batch
+    else:
+        print(f"Webex backup v{version} is being run in python script mode")
+
+    try:
+        if args.config:
+            settings = read_config_file(args.config)
+        else:
+            settings = read_config_file(os.path.join(scriptDir, "webex-backup.ini"), required=False)
+        for name in ['backupScope', 'downloadFiles', 'userAvatar', 'outputToJson', 'incrementalBackup', 'backupFolder', 'metricsReport', 'spaceWorkers']:
+            if getattr(args, name) is not None:
+                settings[name] = getattr(args, name)
+        if args.maxTotalMessages is not None:
+            settings['maxTotalMessages'] = parse_setting('maxTotalMessages', args.maxTotalMessages)
+        if args.sort is not None:
+            settings['sortOldNew'] = args.sort == 'old-new'
+        for setting in args.set:
+            name, _, value = setting.partition("=")
+            if name.strip() not in configSettings:
+                raise ValueError(f"unknown setting '{name.strip()}' in --set {setting}")
+            settings[name.strip()] = parse_setting(name.strip(), value)
+    except (OSError, ValueError, configparser.Error) as e:
+        print("\n   **ERROR** " + str(e) + "\n")
+        beep(3)
+        leave(2)
+    token = args.token or os.environ.get('WEBEX_TOKEN') or settings.pop('token', "")
+    settings.pop('token', None)
+    configure(settings)
+
+    settingsError = check_settings()
+    if settingsError:
+        print(settingsError)
+        beep(3)
+        leave(2)
+
+    if token == "":
+        if args.batch:
+            print("-----------------   **ERROR** No personal access token: give it as argument, in WEBEX_TOKEN or in the config file.  -----------------")
+            leave(2)
+        token = input("Please input your personal access token: ").strip()
+    if len(token) < 55:
+        print("-----------------   **ERROR** Your personal access token is too short.  -----------------")
+        leave(2)
+
+    backup_scope = {'': '', 'direct': '1', 'group': '2', 'all': '3'}[backupScope]
+    if args.batch and backup_scope == '':
+        backup_scope = '3'
+    askFiles = not args.batch and 'downloadFiles' not in settings
+    allSpaces = run_backup(token, backup_scope, askFiles)
+    if spaceListComplete and all(space.result != "failed" for space in allSpaces):
+        return 0
+    return 1
+
+
+# ------------------------------------------------------------------------
+#    Start of non-function code !  #lastfunction
+#
+# ------------------------------------------------------------------------
 
-# ------------------------------- end of code -------------------------------
+if __name__ == "__main__":
+    sys.exit(main())